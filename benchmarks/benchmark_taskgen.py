@@ -0,0 +1,95 @@
+"""Compare one-task-per-call and batched task generation against a stub model.
+
+    python benchmarks/benchmark_taskgen.py --tasks 24 --batch 6 --latency 0.4
+
+Needs no API key: the app's AI client is swapped for StubModelClient, which
+answers with valid task JSON and sleeps like a real model. The app's database
+is created in a temporary directory.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+class StubModelResponse:
+    def __init__(self, text):
+        self.text = text
+
+class StubModelClient:
+    """Offline stand-in for genai.Client.
+    
+    Answers task prompts with valid JSON and sleeps like a real model: a fixed
+    per-call latency plus time per output token (~4 characters a token).
+    """
+    
+    def __init__(self, latency, seconds_per_token=0.004):
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.lock = threading.Lock()
+        self.models = self
+    
+    def generate_content(self, model, contents, config=None):
+        match = re.search(r"Difficulties, in order: ([\w, ]+)\.", contents)
+        difficulties = match.group(1).split(", ") if match else [None]
+        tasks = [
+            {"text": f"Explain concept #{i} of the topic with a worked example.", "difficulty": diff or "Easy",
+             "solution": "A short model answer covering the key idea and one example."}
+            for i, diff in enumerate(difficulties)
+        ]
+        text = json.dumps({"tasks": tasks} if match else tasks[0])
+        output_tokens = len(text) // 4
+        with self.lock:
+            self.calls += 1
+            self.input_tokens += len(contents) // 4
+            self.output_tokens += output_tokens
+        time.sleep(self.latency + output_tokens * self.seconds_per_token)
+        return StubModelResponse(text)
+
+def benchmark_task_generation(app, count, batch_size, latency):
+    user_context = "Subjects: Math, Physics, Learning style: Visual (diagrams, videos)"
+    difficulties = [app.TASK_DIFFICULTIES[i % len(app.TASK_DIFFICULTIES)] for i in range(count)]
+    runs = {
+        "one task per call": lambda: [app.generate_task("Math", "Derivatives", diff, user_context) for diff in difficulties],
+        f"batched ({batch_size}/call)": lambda: [
+            task
+            for start in range(0, count, batch_size)
+            for task in app.generate_tasks("Math", "Derivatives", difficulties[start:start + batch_size], user_context)
+        ],
+    }
+    print(f"Generating {count} tasks against a stub model ({latency}s per call + output time)")
+    for name, run in runs.items():
+        stub = StubModelClient(latency)
+        with mock.patch.object(app, "get_ai_client", return_value=stub):
+            started = time.perf_counter()
+            tasks = [task for task in run() if task]
+            elapsed = time.perf_counter() - started
+        tokens = stub.input_tokens + stub.output_tokens
+        print(
+            f"  {name:<22} {stub.calls:>3} calls  {len(tasks) / elapsed:6.2f} tasks/s  "
+            f"{tokens / max(len(tasks), 1):6.1f} tokens/task"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare one-task and batched generation against a stub model")
+    parser.add_argument("--tasks", type=int, default=24)
+    parser.add_argument("--batch", type=int, help="Tasks per call (default: the app's TASK_BATCH_SIZE)")
+    parser.add_argument("--latency", type=float, default=0.4, help="Stub model's fixed seconds per call")
+    args = parser.parse_args()
+    
+    os.chdir(tempfile.mkdtemp(prefix="brainwash-bench-"))
+    import brainWash
+    benchmark_task_generation(brainWash, args.tasks, args.batch or brainWash.TASK_BATCH_SIZE, args.latency)
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,346 @@
 import streamlit as st
 from google import genai
-from google.genai import types
+from google.genai import types, errors as genai_errors
 import json
 import os
-import pypdf
+import sys
+import argparse
 import html
 import pandas as pd
+import numpy as np
 import time
+import httpx
 from datetime import datetime, date, timedelta
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 import sqlite3
 from pathlib import Path
 import io
+import csv
+import tempfile
 import hashlib
+import random
+import re
+import math
+import unicodedata
+import queue
+import threading
+import functools
+import traceback
+import atexit
+import mmap
+import weakref
+import zipfile
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # Columnar exports are unavailable without pyarrow
+    pa = None
+
+from pdf_extract import PdfWorkerPool, extract_pdf_text
 
 # --- 1. Database Setup ---
 DB_PATH = Path("brainwash.db")
+DB_SCHEMA_VERSION = 4
+DB_POOL_SIZE = 4
+EXPORT_PAGE_SIZE = 1000
+BULK_EXPORT_PAGE_SIZE = 50000
+MAX_ROW_ID = 2**63 - 1
+DB_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+class ConnectionPool:
+    """Small pool of long-lived SQLite connections shared by every DB helper"""
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        # Connections outlive the script thread that opened them, and the
+        # per-connection statement cache keeps hot queries prepared.
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=256)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self.connect()
+            except Exception:
+                self.slots.release()
+                raise
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put_nowait(conn)
+        self.slots.release()
+
+@st.cache_resource
+def get_db_pool():
+    """One connection pool per server process"""
+    return ConnectionPool(DB_PATH)
+
+@contextmanager
+def db_cursor(immediate=False):
+    """Borrow a pooled connection; commit on success, roll back on error.
+
+    Pass immediate=True for read-modify-write work so the write lock is taken
+    up front instead of failing with "database is locked" on upgrade.
+    """
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        cursor = conn.cursor()
+        if immediate:
+            cursor.execute("BEGIN IMMEDIATE")
+        yield cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+def local_today():
+    """Today's date in the user's browser timezone, falling back to the server's"""
+    tz_name = getattr(getattr(st, "context", None), "timezone", None)
+    if tz_name:
+        try:
+            return datetime.now(ZoneInfo(tz_name)).date()
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return date.today()
 
 def hash_password(password):
     """Hash password using SHA-256"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+@st.cache_resource
 def init_database():
     """Initialize SQLite database with User and TaskCompletion tables"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with db_cursor() as cursor:
+        # User table with password
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS User (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                total_xp INTEGER DEFAULT 0,
+                tasks_completed INTEGER DEFAULT 0,
+                daily_goal INTEGER DEFAULT 3,
+                streak_days INTEGER DEFAULT 0,
+                last_activity_date TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                subjects_interested TEXT,
+                learning_style TEXT,
+                weekly_commitment INTEGER DEFAULT 3
+            )
+        """)
+        
+        # TaskCompletion table
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS TaskCompletion (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                task_text TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                xp_earned INTEGER NOT NULL,
+                subject TEXT,
+                topic TEXT,
+                user_answer TEXT,
+                ai_feedback TEXT,
+                completed_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                day_key TEXT,
+                FOREIGN KEY (user_id) REFERENCES User(id)
+            )
+        """)
+        
+        migrate_database(cursor)
+
+def migrate_database(cursor):
+    """Upgrade an existing database to DB_SCHEMA_VERSION (tracked in PRAGMA user_version)"""
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    
+    if version < 1:
+        # day_key is the local calendar day a task was completed on, stored at
+        # write time so per-day queries can use an index instead of DATE(...)
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(TaskCompletion)")}
+        if "day_key" not in columns:
+            cursor.execute("ALTER TABLE TaskCompletion ADD COLUMN day_key TEXT")
+        cursor.execute("""
+            UPDATE TaskCompletion SET day_key = DATE(completed_at, 'localtime')
+            WHERE day_key IS NULL
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_taskcompletion_user_day
+            ON TaskCompletion (user_id, day_key, xp_earned)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_taskcompletion_user_id
+            ON TaskCompletion (user_id, id)
+        """)
     
-    # User table with password
+    if version < 2:
+        # Per-user rollups kept in step with TaskCompletion by an insert
+        # trigger, so dashboards never have to scan raw history
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS UserDailyStats (
+                user_id INTEGER NOT NULL,
+                day_key TEXT NOT NULL,
+                tasks_completed INTEGER NOT NULL DEFAULT 0,
+                xp_earned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day_key)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS UserDifficultyStats (
+                user_id INTEGER NOT NULL,
+                difficulty TEXT NOT NULL,
+                tasks_completed INTEGER NOT NULL DEFAULT 0,
+                xp_earned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, difficulty)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS UserSubjectStats (
+                user_id INTEGER NOT NULL,
+                subject TEXT NOT NULL,
+                tasks_completed INTEGER NOT NULL DEFAULT 0,
+                xp_earned INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, subject)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_taskcompletion_rollups
+            AFTER INSERT ON TaskCompletion
+            BEGIN
+                INSERT INTO UserDailyStats (user_id, day_key, tasks_completed, xp_earned)
+                VALUES (NEW.user_id, IFNULL(NEW.day_key, DATE(NEW.completed_at, 'localtime')), 1, NEW.xp_earned)
+                ON CONFLICT (user_id, day_key) DO UPDATE
+                SET tasks_completed = tasks_completed + 1, xp_earned = xp_earned + excluded.xp_earned;
+                
+                INSERT INTO UserDifficultyStats (user_id, difficulty, tasks_completed, xp_earned)
+                VALUES (NEW.user_id, NEW.difficulty, 1, NEW.xp_earned)
+                ON CONFLICT (user_id, difficulty) DO UPDATE
+                SET tasks_completed = tasks_completed + 1, xp_earned = xp_earned + excluded.xp_earned;
+                
+                INSERT INTO UserSubjectStats (user_id, subject, tasks_completed, xp_earned)
+                VALUES (NEW.user_id, IFNULL(NEW.subject, ''), 1, NEW.xp_earned)
+                ON CONFLICT (user_id, subject) DO UPDATE
+                SET tasks_completed = tasks_completed + 1, xp_earned = xp_earned + excluded.xp_earned;
+            END
+        """)
+        rebuild_rollups(cursor)
+    
+    if version < 3:
+        # Last TaskCompletion.id each user has exported, for delta exports
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ExportWatermark (
+                user_id INTEGER PRIMARY KEY,
+                last_task_id INTEGER NOT NULL DEFAULT 0,
+                exported_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES User(id)
+            )
+        """)
+    
+    if version < 4:
+        # Disk tier of the AI response cache (see ResponseCache)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS AIResponseCache (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_airesponsecache_last_used
+            ON AIResponseCache (last_used)
+        """)
+    
+    cursor.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
+
+def rebuild_rollups(cursor):
+    """Recompute every rollup table from raw TaskCompletion history in one pass"""
+    # One scan of the raw table into a temp aggregate; the three rollups are
+    # then derived from that much smaller table
+    cursor.execute("DROP TABLE IF EXISTS temp.TaskRollup")
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS User (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            total_xp INTEGER DEFAULT 0,
-            tasks_completed INTEGER DEFAULT 0,
-            daily_goal INTEGER DEFAULT 3,
-            streak_days INTEGER DEFAULT 0,
-            last_activity_date TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            subjects_interested TEXT,
-            learning_style TEXT,
-            weekly_commitment INTEGER DEFAULT 3
-        )
+        CREATE TEMP TABLE TaskRollup AS
+        SELECT user_id,
+               IFNULL(day_key, DATE(completed_at, 'localtime')) AS day_key,
+               difficulty,
+               IFNULL(subject, '') AS subject,
+               COUNT(*) AS tasks_completed,
+               SUM(xp_earned) AS xp_earned
+        FROM TaskCompletion
+        GROUP BY 1, 2, 3, 4
     """)
     
-    # TaskCompletion table
+    cursor.execute("DELETE FROM UserDailyStats")
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS TaskCompletion (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_text TEXT NOT NULL,
-            difficulty TEXT NOT NULL,
-            xp_earned INTEGER NOT NULL,
-            subject TEXT,
-            topic TEXT,
-            user_answer TEXT,
-            ai_feedback TEXT,
-            completed_at TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES User(id)
-        )
+        INSERT INTO UserDailyStats (user_id, day_key, tasks_completed, xp_earned)
+        SELECT user_id, day_key, SUM(tasks_completed), SUM(xp_earned)
+        FROM TaskRollup GROUP BY user_id, day_key
+    """)
+    cursor.execute("DELETE FROM UserDifficultyStats")
+    cursor.execute("""
+        INSERT INTO UserDifficultyStats (user_id, difficulty, tasks_completed, xp_earned)
+        SELECT user_id, difficulty, SUM(tasks_completed), SUM(xp_earned)
+        FROM TaskRollup GROUP BY user_id, difficulty
+    """)
+    cursor.execute("DELETE FROM UserSubjectStats")
+    cursor.execute("""
+        INSERT INTO UserSubjectStats (user_id, subject, tasks_completed, xp_earned)
+        SELECT user_id, subject, SUM(tasks_completed), SUM(xp_earned)
+        FROM TaskRollup GROUP BY user_id, subject
     """)
     
-    conn.commit()
-    conn.close()
+    cursor.execute("DROP TABLE temp.TaskRollup")
 
 def create_user(username, password, onboarding_data=None):
     """Create new user with hashed password"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute("""
-            INSERT INTO User (username, password_hash, subjects_interested, learning_style, weekly_commitment, daily_goal)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            username,
-            hash_password(password),
-            onboarding_data.get('subjects', '') if onboarding_data else '',
-            onboarding_data.get('style', '') if onboarding_data else '',
-            onboarding_data.get('commitment', 3) if onboarding_data else 3,
-            onboarding_data.get('daily_goal', 3) if onboarding_data else 3
-        ))
-        conn.commit()
-        success = True
+        with db_cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO User (username, password_hash, subjects_interested, learning_style, weekly_commitment, daily_goal)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                username,
+                hash_password(password),
+                onboarding_data.get('subjects', '') if onboarding_data else '',
+                onboarding_data.get('style', '') if onboarding_data else '',
+                onboarding_data.get('commitment', 3) if onboarding_data else 3,
+                onboarding_data.get('daily_goal', 3) if onboarding_data else 3
+            ))
+        return True
     except sqlite3.IntegrityError:
-        success = False
-    
-    conn.close()
-    return success
+        return False
 
 def verify_login(username, password):
     """Verify username and password"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT password_hash FROM User WHERE username = ?", (username,))
-    result = cursor.fetchone()
-    conn.close()
+    with db_cursor() as cursor:
+        cursor.execute("SELECT password_hash FROM User WHERE username = ?", (username,))
+        result = cursor.fetchone()
     
     if result and result[0] == hash_password(password):
         return True
@@ -104,199 +348,552 @@ def verify_login(username, password):
 
 def get_user(username):
     """Get user data by username"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM User WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    
-    conn.close()
-    return user
+    with db_cursor() as cursor:
+        cursor.execute("SELECT * FROM User WHERE username = ?", (username,))
+        return cursor.fetchone()
 
 def user_exists(username):
     """Check if username exists"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
-    exists = cursor.fetchone() is not None
-    conn.close()
-    return exists
+    with db_cursor() as cursor:
+        cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
+        return cursor.fetchone() is not None
+
+def get_user_id(username):
+    """Resolve a username to its User.id (None if unknown)"""
+    with db_cursor() as cursor:
+        cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
+        user = cursor.fetchone()
+    return user[0] if user else None
+
+# Arithmetic stats update: no read-modify-write, so concurrent tabs can't lose XP
+USER_STATS_UPDATE_SQL = """
+    UPDATE User
+    SET total_xp = total_xp + :xp,
+        tasks_completed = tasks_completed + :tasks,
+        streak_days = CASE
+            WHEN last_activity_date = :today THEN streak_days
+            WHEN last_activity_date = :yesterday THEN streak_days + 1
+            ELSE 1
+        END,
+        last_activity_date = :today
+    WHERE id = :user_id
+"""
+
+TASK_INSERT_SQL = """
+    INSERT INTO TaskCompletion (user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback, day_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def user_stats_params(user_id, xp_gained, task_completed):
+    today = local_today()
+    return {
+        "xp": xp_gained,
+        "tasks": 1 if task_completed else 0,
+        "today": str(today),
+        "yesterday": str(today - timedelta(days=1)),
+        "user_id": user_id,
+    }
+
+def update_user_stats_by_id(user_id, xp_gained=0, task_completed=False):
+    """Update user XP, tasks, and streak; returns the updated User row (None when write-behind queued it)"""
+    writer = get_write_behind()
+    if writer:
+        writer.submit(user_stats_params(user_id, xp_gained, task_completed))
+        return None
+    
+    with db_cursor() as cursor:
+        cursor.execute(USER_STATS_UPDATE_SQL + "RETURNING *", user_stats_params(user_id, xp_gained, task_completed))
+        return cursor.fetchone()
 
 def update_user_stats(username, xp_gained=0, task_completed=False):
     """Update user XP, tasks, and streak"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Get current user data
-    cursor.execute("SELECT id, total_xp, tasks_completed, streak_days, last_activity_date FROM User WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    
-    if user:
-        user_id, current_xp, current_tasks, streak, last_date = user
-        new_xp = current_xp + xp_gained
-        new_tasks = current_tasks + (1 if task_completed else 0)
-        
-        # Update streak
-        today = str(date.today())
-        new_streak = streak
-        if last_date != today:
-            if last_date == str(date.today() - timedelta(days=1)):
-                new_streak = streak + 1
-            else:
-                new_streak = 1
-        
+    user_id = get_user_id(username)
+    return update_user_stats_by_id(user_id, xp_gained, task_completed) if user_id else None
+
+def update_user_profile(username, subjects, learning_style, weekly_commitment, daily_goal):
+    """Update user learning preferences"""
+    with db_cursor() as cursor:
         cursor.execute("""
             UPDATE User 
-            SET total_xp = ?, tasks_completed = ?, streak_days = ?, last_activity_date = ?
+            SET subjects_interested = ?, learning_style = ?, weekly_commitment = ?, daily_goal = ?
             WHERE username = ?
-        """, (new_xp, new_tasks, new_streak, today, username))
-        
-        conn.commit()
-    
-    conn.close()
+        """, (subjects, learning_style, weekly_commitment, daily_goal, username))
 
-def update_user_profile(username, subjects, learning_style, weekly_commitment, daily_goal):
-    """Update user learning preferences"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE User 
-        SET subjects_interested = ?, learning_style = ?, weekly_commitment = ?, daily_goal = ?
-        WHERE username = ?
-    """, (subjects, learning_style, weekly_commitment, daily_goal, username))
-    conn.commit()
-    conn.close()
+def log_task_completion_by_id(user_id, task_text, difficulty, xp_earned, subject, topic, user_answer="", ai_feedback=""):
+    """Log a completed task with optional answer and feedback"""
+    with db_cursor() as cursor:
+        cursor.execute(TASK_INSERT_SQL, (user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback, str(local_today())))
 
 def log_task_completion(username, task_text, difficulty, xp_earned, subject, topic, user_answer="", ai_feedback=""):
     """Log a completed task with optional answer and feedback"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    
-    if user:
-        cursor.execute("""
-            INSERT INTO TaskCompletion (user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (user[0], task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback))
-        conn.commit()
-    
-    conn.close()
+    user_id = get_user_id(username)
+    if user_id:
+        log_task_completion_by_id(user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback)
 
-def get_user_analytics(username):
-    """Get analytics data for insights dashboard"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+def complete_task_by_id(user_id, task_text, difficulty, xp_earned, subject, topic, user_answer="", ai_feedback=""):
+    """Award XP, bump the streak and log the task in one transaction.
     
-    # Get user ID
-    cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    
-    if not user:
-        conn.close()
+    Rollups are updated by trigger inside the same transaction. Returns the
+    updated User row, or None if the user doesn't exist or write-behind mode
+    queued the completion.
+    """
+    task_row = (user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback, str(local_today()))
+    writer = get_write_behind()
+    if writer:
+        writer.submit(user_stats_params(user_id, xp_earned, True), task_row)
         return None
     
-    user_id = user[0]
+    with db_cursor(immediate=True) as cursor:
+        cursor.execute(USER_STATS_UPDATE_SQL + "RETURNING *", user_stats_params(user_id, xp_earned, True))
+        user = cursor.fetchone()
+        
+        if user:
+            cursor.execute(TASK_INSERT_SQL, task_row)
     
-    # Tasks by day (last 7 days)
-    cursor.execute("""
-        SELECT DATE(completed_at) as day, COUNT(*) as count
-        FROM TaskCompletion
-        WHERE user_id = ? AND DATE(completed_at) >= DATE('now', '-7 days')
-        GROUP BY DATE(completed_at)
-        ORDER BY day
-    """, (user_id,))
-    daily_tasks = cursor.fetchall()
+    return user
+
+def complete_task(username, task_text, difficulty, xp_earned, subject, topic, user_answer="", ai_feedback=""):
+    """Award XP, bump the streak and log the task in one transaction"""
+    user_id = get_user_id(username)
+    return complete_task_by_id(user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback) if user_id else None
+
+def complete_tasks_by_id(user_id, completions, subject, topic):
+    """Award XP and log several tasks in one transaction.
     
-    # XP by day (last 7 days)
-    cursor.execute("""
-        SELECT DATE(completed_at) as day, SUM(xp_earned) as total_xp
-        FROM TaskCompletion
-        WHERE user_id = ? AND DATE(completed_at) >= DATE('now', '-7 days')
-        GROUP BY DATE(completed_at)
-        ORDER BY day
-    """, (user_id,))
-    daily_xp = cursor.fetchall()
+    `completions` holds (task_text, difficulty, xp_earned, user_answer,
+    ai_feedback) tuples; the streak moves at most once. Returns the updated
+    User row like complete_task_by_id.
+    """
+    today = str(local_today())
+    task_rows = [
+        (user_id, task_text, difficulty, xp_earned, subject, topic, user_answer, ai_feedback, today)
+        for task_text, difficulty, xp_earned, user_answer, ai_feedback in completions
+    ]
+    if not task_rows:
+        return None
+    writer = get_write_behind()
+    if writer:
+        for task_row in task_rows:
+            writer.submit(user_stats_params(user_id, task_row[3], True), task_row)
+        return None
     
-    # Tasks by difficulty
-    cursor.execute("""
-        SELECT difficulty, COUNT(*) as count
-        FROM TaskCompletion
-        WHERE user_id = ?
-        GROUP BY difficulty
-    """, (user_id,))
-    difficulty_breakdown = cursor.fetchall()
+    stats = dict(user_stats_params(user_id, sum(task_row[3] for task_row in task_rows), True), tasks=len(task_rows))
+    with db_cursor(immediate=True) as cursor:
+        cursor.execute(USER_STATS_UPDATE_SQL + "RETURNING *", stats)
+        user = cursor.fetchone()
+        
+        if user:
+            cursor.executemany(TASK_INSERT_SQL, task_rows)
     
-    # Tasks by subject
-    cursor.execute("""
-        SELECT subject, COUNT(*) as count, SUM(xp_earned) as total_xp
-        FROM TaskCompletion
-        WHERE user_id = ?
-        GROUP BY subject
-        ORDER BY count DESC
-        LIMIT 5
-    """, (user_id,))
-    subject_stats = cursor.fetchall()
-    
-    # Recent tasks
-    cursor.execute("""
-        SELECT task_text, difficulty, xp_earned, subject, completed_at
-        FROM TaskCompletion
-        WHERE user_id = ?
-        ORDER BY completed_at DESC
-        LIMIT 10
-    """, (user_id,))
-    recent_tasks = cursor.fetchall()
+    return user
+
+def complete_tasks(username, completions, subject, topic):
+    """Award XP and log several tasks in one transaction"""
+    user_id = get_user_id(username)
+    return complete_tasks_by_id(user_id, completions, subject, topic) if user_id else None
+
+def is_database_busy(error):
+    """Whether an sqlite3 error is another connection holding the lock, which passes by itself"""
+    code = getattr(error, "sqlite_errorcode", None)  # Python 3.11+
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error) or "busy" in str(error)
+
+class WriteBehindQueue:
+    """Buffers stats updates and completions, committing them in batches from a background thread.
     
-    # All tasks for export
-    cursor.execute("""
-        SELECT completed_at, subject, topic, task_text, difficulty, xp_earned
-        FROM TaskCompletion
-        WHERE user_id = ?
-        ORDER BY completed_at DESC
-    """, (user_id,))
-    all_tasks = cursor.fetchall()
+    Each event is a USER_STATS_UPDATE_SQL parameter dict plus an optional
+    TASK_INSERT_SQL row. Until an event is committed its effect is
+    kept in an in-memory overlay so readers still see the latest totals;
+    read() pairs a database read with exactly the overlay it doesn't include.
+    """
     
-    conn.close()
+    def __init__(self, max_delay=0.05, max_batch=500):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.events = queue.Queue()
+        self.lock = threading.Condition()
+        self.pending = {}
+        # User ids with a batch being committed, and a count of finished flushes
+        self.flushing = Counter()
+        self.flushes = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="brainwash-write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def submit(self, stats, task=None):
+        with self.lock:
+            pending = self.pending.setdefault(stats["user_id"], {"xp": 0, "tasks": 0, "activity": [], "days": {}})
+            pending["xp"] += stats["xp"]
+            pending["tasks"] += stats["tasks"]
+            pending["activity"].append((stats["today"], stats["yesterday"]))
+            if task:
+                day_key = task[8]
+                pending["days"][day_key] = pending["days"].get(day_key, 0) + 1
+        self.events.put((stats, task))
+    
+    def run(self):
+        while not (self.stopping.is_set() and self.events.empty()):
+            try:
+                batch = [self.events.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            
+            # Group commit: gather whatever else arrives within max_delay
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.events.get(timeout=remaining) if remaining > 0 else self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception:
+                # Never let one bad batch stop the writer thread
+                print("Write-behind flush crashed:", file=sys.stderr)
+                traceback.print_exc()
+    
+    def write(self, batch, attempts=5):
+        """Commit a batch in one transaction, retrying for as long as the database is locked.
+        
+        Users were already told about these events, so a busy database is
+        waited out; only at shutdown does it give up after `attempts` tries.
+        """
+        attempt = 0
+        while True:
+            try:
+                with db_cursor(immediate=True) as cursor:
+                    cursor.executemany(USER_STATS_UPDATE_SQL, [stats for stats, _ in batch])
+                    cursor.executemany(TASK_INSERT_SQL, [task for _, task in batch if task])
+                return
+            except sqlite3.OperationalError as e:
+                attempt += 1
+                if not is_database_busy(e) or (self.stopping.is_set() and attempt >= attempts):
+                    raise
+                print(f"Write-behind flush failed (attempt {attempt}): {e}", file=sys.stderr)
+                time.sleep(min(0.1 * 2 ** attempt, 5.0))
+    
+    def flush(self, batch):
+        user_ids = [stats["user_id"] for stats, _ in batch]
+        with self.lock:
+            self.flushing.update(user_ids)
+        try:
+            try:
+                self.write(batch)
+            except sqlite3.Error as e:
+                if is_database_busy(e):  # Still locked while shutting down
+                    print(f"Write-behind dropped {len(batch)} events: {e}", file=sys.stderr)
+                    return
+                # A bad row fails the whole transaction; commit the rest one by one
+                print(f"Write-behind batch failed, retrying row by row: {e}", file=sys.stderr)
+                for event in batch:
+                    try:
+                        self.write([event])
+                    except sqlite3.Error as e:
+                        print(f"Write-behind dropped event {event[0]}: {e}", file=sys.stderr)
+        finally:
+            with self.lock:
+                for stats, task in batch:
+                    pending = self.pending[stats["user_id"]]
+                    pending["xp"] -= stats["xp"]
+                    pending["tasks"] -= stats["tasks"]
+                    pending["activity"].pop(0)
+                    if task:
+                        pending["days"][task[8]] -= 1
+                    if not pending["activity"]:
+                        del self.pending[stats["user_id"]]
+                for user_id in user_ids:
+                    self.flushing[user_id] -= 1
+                    if not self.flushing[user_id]:
+                        del self.flushing[user_id]
+                self.flushes += 1
+                self.lock.notify_all()
+    
+    def read(self, fetch, user_id=None):
+        """(fetch(), overlay) where the overlay holds exactly the user's events fetch() didn't see.
+        
+        fetch reads the user's rows from the database; user_id defaults to
+        the first column of its result. A read that overlaps a flush of the
+        same user is repeated, so no event is counted twice or missed.
+        """
+        while True:
+            with self.lock:
+                flushes = self.flushes
+            result = fetch()
+            key = user_id if user_id is not None else (result[0] if result else None)
+            with self.lock:
+                if key not in self.flushing and self.flushes == flushes:
+                    pending = self.pending.get(key)
+                    return result, pending and {
+                        "xp": pending["xp"],
+                        "tasks": pending["tasks"],
+                        "activity": list(pending["activity"]),
+                        "days": dict(pending["days"]),
+                    }
+                self.lock.wait_for(lambda: key not in self.flushing)
+    
+    @staticmethod
+    def apply_pending(user_data, pending):
+        """Fold an overlay from read() into a user_db_data dict"""
+        if not pending:
+            return user_data
+        user_data['total_xp'] += pending["xp"]
+        user_data['tasks_completed'] += pending["tasks"]
+        # Replay the streak CASE from USER_STATS_UPDATE_SQL
+        for today, yesterday in pending["activity"]:
+            if user_data['last_activity_date'] == yesterday:
+                user_data['streak_days'] += 1
+            elif user_data['last_activity_date'] != today:
+                user_data['streak_days'] = 1
+            user_data['last_activity_date'] = today
+        return user_data
+    
+    def close(self):
+        """Commit everything still queued; called at interpreter shutdown"""
+        self.stopping.set()
+        self.thread.join(timeout=30)
+
+@st.cache_resource
+def create_write_behind_queue():
+    return WriteBehindQueue(max_delay=float(get_setting("BRAINWASH_WRITE_BEHIND_DELAY", "0.05")))
+
+def get_write_behind():
+    """The process-wide write-behind queue, or None unless BRAINWASH_WRITE_BEHIND is enabled"""
+    if not get_flag("BRAINWASH_WRITE_BEHIND"):
+        return None
+    return create_write_behind_queue()
+
+def get_user_analytics_by_id(user_id):
+    """Get analytics data for insights dashboard"""
+    with db_cursor() as cursor:
+        week_start = str(local_today() - timedelta(days=7))
+        
+        # Tasks and XP by day (last 7 days)
+        cursor.execute("""
+            SELECT day_key, tasks_completed, xp_earned
+            FROM UserDailyStats
+            WHERE user_id = ? AND day_key >= ?
+            ORDER BY day_key
+        """, (user_id, week_start))
+        daily_rows = cursor.fetchall()
+        daily_tasks = [(day, count) for day, count, _ in daily_rows]
+        daily_xp = [(day, xp) for day, _, xp in daily_rows]
+        
+        # Tasks by difficulty
+        cursor.execute("""
+            SELECT difficulty, tasks_completed
+            FROM UserDifficultyStats
+            WHERE user_id = ?
+        """, (user_id,))
+        difficulty_breakdown = cursor.fetchall()
+        
+        # Tasks by subject
+        cursor.execute("""
+            SELECT subject, tasks_completed, xp_earned
+            FROM UserSubjectStats
+            WHERE user_id = ?
+            ORDER BY tasks_completed DESC
+            LIMIT 5
+        """, (user_id,))
+        subject_stats = cursor.fetchall()
+        
+        # Recent tasks
+        cursor.execute("""
+            SELECT task_text, difficulty, xp_earned, subject, completed_at
+            FROM TaskCompletion
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT 10
+        """, (user_id,))
+        recent_tasks = cursor.fetchall()
     
     return {
         'daily_tasks': daily_tasks,
         'daily_xp': daily_xp,
         'difficulty_breakdown': difficulty_breakdown,
         'subject_stats': subject_stats,
-        'recent_tasks': recent_tasks,
-        'all_tasks': all_tasks
+        'recent_tasks': recent_tasks
     }
 
+def get_user_analytics(username):
+    """Get analytics data for insights dashboard"""
+    user_id = get_user_id(username)
+    return get_user_analytics_by_id(user_id) if user_id else None
+
+def get_today_progress_by_id(user_id):
+    """Get today's task completion count"""
+    today = str(local_today())
+    
+    def fetch():
+        with db_cursor() as cursor:
+            cursor.execute("""
+                SELECT tasks_completed FROM UserDailyStats
+                WHERE user_id = ? AND day_key = ?
+            """, (user_id, today))
+            return cursor.fetchone()
+    
+    writer = get_write_behind()
+    if not writer:
+        row = fetch()
+        return row[0] if row else 0
+    row, pending = writer.read(fetch, user_id)
+    return (row[0] if row else 0) + (pending["days"].get(today, 0) if pending else 0)
+
 def get_today_progress(username):
     """Get today's task completion count"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    user_id = get_user_id(username)
+    return get_today_progress_by_id(user_id) if user_id else 0
+
+def iter_task_pages(user_id=None, after_id=0, until_id=MAX_ROW_ID, page_size=EXPORT_PAGE_SIZE):
+    """Yield TaskCompletion rows with after_id < id <= until_id oldest first, one page at a time.
     
-    cursor.execute("SELECT id FROM User WHERE username = ?", (username,))
-    user = cursor.fetchone()
+    Covers one user, or every user when user_id is None. Keyset pagination on
+    (user_id, id) makes every page an index range scan, and the pooled
+    connection is handed back between pages.
+    """
+    columns = "id, user_id, completed_at, day_key, subject, topic, task_text, difficulty, xp_earned"
+    while True:
+        with db_cursor() as cursor:
+            if user_id is None:
+                cursor.execute(f"""
+                    SELECT {columns} FROM TaskCompletion
+                    WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+                """, (after_id, until_id, page_size))
+            else:
+                cursor.execute(f"""
+                    SELECT {columns} FROM TaskCompletion
+                    WHERE user_id = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?
+                """, (user_id, after_id, until_id, page_size))
+            page = cursor.fetchall()
+        if not page:
+            return
+        yield page
+        after_id = page[-1][0]
+
+def iter_task_history_csv(user_id, after_id=0, until_id=MAX_ROW_ID):
+    """Stream a user's task history (optionally an id range of it) as UTF-8 CSV chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Completed At', 'Subject', 'Topic', 'Task', 'Difficulty', 'XP Earned'])
+    for page in iter_task_pages(user_id, after_id, until_id):
+        writer.writerows(row[2:3] + row[4:] for row in page)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def task_export_schema():
+    return pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.int64()),
+        ("completed_at", pa.timestamp("s", tz="UTC")),
+        ("day_key", pa.date32()),
+        ("subject", pa.string()),
+        ("topic", pa.string()),
+        ("task_text", pa.string()),
+        ("difficulty", pa.string()),
+        ("xp_earned", pa.int32()),
+    ])
+
+def task_page_to_batch(page, schema):
+    """Convert one page from iter_task_pages into a typed Arrow record batch"""
+    ids, user_ids, completed_at, day_keys, subjects, topics, texts, difficulties, xp = zip(*page)
+    completed_at = pc.strptime(pa.array(completed_at, pa.string()), format="%Y-%m-%d %H:%M:%S", unit="s", error_is_null=True)
+    return pa.record_batch([
+        pa.array(ids, pa.int64()),
+        pa.array(user_ids, pa.int64()),
+        completed_at.cast(pa.timestamp("s", tz="UTC")),
+        pa.array(day_keys, pa.string()).cast(pa.date32()),
+        pa.array(subjects, pa.string()),
+        pa.array(topics, pa.string()),
+        pa.array(texts, pa.string()),
+        pa.array(difficulties, pa.string()),
+        pa.array(xp, pa.int32()),
+    ], schema=schema)
+
+def export_task_history_columnar(sink, fmt="parquet", user_id=None, page_size=EXPORT_PAGE_SIZE, after_id=0, until_id=MAX_ROW_ID):
+    """Write task history as Parquet or Arrow IPC, one page per row group / record batch.
     
-    if not user:
-        conn.close()
-        return 0
+    Exports one user, or every user when user_id is None. Only a single page
+    is ever held in memory. Returns the number of rows written.
+    """
+    if pa is None:
+        raise RuntimeError("Parquet/Arrow export needs pyarrow (pip install pyarrow)")
+    
+    schema = task_export_schema()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    elif fmt == "arrow":
+        writer = pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
     
-    today = str(date.today())
-    cursor.execute("""
-        SELECT COUNT(*) FROM TaskCompletion
-        WHERE user_id = ? AND DATE(completed_at) = ?
-    """, (user[0], today))
+    rows = 0
+    try:
+        for page in iter_task_pages(user_id, after_id, until_id, page_size):
+            writer.write_batch(task_page_to_batch(page, schema))
+            rows += len(page)
+    finally:
+        writer.close()
+    return rows
+
+def begin_delta_export(user_id, full_resync=False):
+    """Return the (after_id, until_id) range of task ids a delta export should cover.
     
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    after_id is the user's watermark (0 for a full resync); until_id pins the
+    newest row now, so tasks completed mid-export wait for the next delta.
+    """
+    with db_cursor() as cursor:
+        after_id = 0
+        if not full_resync:
+            cursor.execute("SELECT last_task_id FROM ExportWatermark WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            after_id = row[0] if row else 0
+        cursor.execute("SELECT MAX(id) FROM TaskCompletion WHERE user_id = ?", (user_id,))
+        until_id = cursor.fetchone()[0] or 0
+    return after_id, max(until_id, after_id)
+
+def commit_delta_export(user_id, until_id):
+    """Advance the user's export watermark once an export has been downloaded (never moves it back)"""
+    with db_cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO ExportWatermark (user_id, last_task_id, exported_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE
+            SET last_task_id = MAX(last_task_id, excluded.last_task_id), exported_at = excluded.exported_at
+        """, (user_id, until_id))
+
+def spool_export(write):
+    """Run write(file) against a temporary file and return it reopened for reading"""
+    with tempfile.NamedTemporaryFile(delete=False) as out:
+        write(out)
+    export = open(out.name, "rb")
+    os.unlink(out.name)
+    return export
 
 # Initialize database
 init_database()
 
 # --- 2. Init & Config ---
 load_dotenv()
-API_KEY = st.secrets.get("GOOGLE_API_KEY") or os.getenv("GOOGLE_API_KEY")
+
+def get_setting(name, default=None):
+    """Read a setting from Streamlit secrets, falling back to the environment"""
+    try:
+        value = st.secrets.get(name)
+    except FileNotFoundError:  # No secrets.toml, e.g. a .env-only setup
+        value = None
+    # Only a missing secret falls through: `false` or `0` in secrets.toml must still count
+    return value if value is not None else os.getenv(name) or default
+
+def get_flag(name, default=False):
+    value = get_setting(name)
+    return default if value is None else str(value).strip().lower() in ("1", "true", "yes", "on")
+
+API_KEY = get_setting("GOOGLE_API_KEY")
 
 st.set_page_config(
     page_title="BrainWash: Arcade",
@@ -507,29 +1104,836 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 3. AI Core
-def get_ai_client():
+@st.cache_resource
+def create_ai_client(api_key):
+    """One Gemini client per server process, shared by every session and thread.
+    
+    The underlying httpx pool keeps TLS connections alive between calls, so
+    only the first request after startup (or an idle gap) pays the handshake.
+    """
+    max_connections = int(get_setting("BRAINWASH_AI_MAX_CONNECTIONS", "20"))
+    http_options = types.HttpOptions(
+        timeout=int(float(get_setting("BRAINWASH_AI_TIMEOUT", "60")) * 1000),
+        client_args={
+            "limits": httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=float(get_setting("BRAINWASH_AI_KEEPALIVE", "120")),
+            )
+        },
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+def report_ai_error(level, message, errors=None):
+    """Show an AI failure with st.<level>, or append (level, message) to `errors`.
+    
+    Calls running on worker threads pass a list, since only the script thread
+    can show anything; the script thread shows it later with show_ai_errors.
+    """
+    if errors is None:
+        getattr(st, level)(message)
+    else:
+        errors.append((level, message))
+
+def show_ai_errors(errors):
+    for level, message in errors:
+        getattr(st, level)(message)
+
+def get_ai_client(errors=None):
     if not API_KEY:
-        st.error("Missing API Key!")
+        report_ai_error("error", "Missing API Key!", errors)
         return None
-    return genai.Client(api_key=API_KEY)
+    return create_ai_client(API_KEY)
 
-def get_ai_response(prompt, is_json=False):
-    client = get_ai_client()
-    if not client: return None
-    model_id = "gemini-2.5-flash"
-    config = types.GenerateContentConfig(
+AI_MODEL = "gemini-2.5-flash"
+# Bump whenever a prompt template changes so stale cached responses are ignored
+PROMPT_VERSION = 1
+NEW_TASK_CACHE_VARIANTS = 3
+TASK_DIFFICULTIES = ("Easy", "Medium", "Hard")
+TASK_XP = {"Easy": 50, "Medium": 150, "Hard": 300}
+PLAN_STREAM_RETRIES = 1
+# Tasks per difficulty in a mission plan; must agree with plan_prompt
+PLAN_MIX = {"Hard": 1, "Medium": 2, "Easy": 2}
+TASK_BATCH_SIZE = 6
+
+class ResponseCache:
+    """Two-tier cache of AI responses: an in-memory LRU in front of an SQLite table.
+    
+    Entries expire after ttl seconds; the disk tier is trimmed to max_bytes by
+    least-recent use. Hit and miss counts are kept per tier.
+    """
+    
+    def __init__(self, max_items=512, ttl=7 * 24 * 3600, max_bytes=50 * 1024 * 1024):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0}
+    
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[0]
+            self.memory.pop(key, None)
+        
+        with db_cursor() as cursor:
+            cursor.execute("""
+                SELECT response, created_at FROM AIResponseCache
+                WHERE cache_key = ? AND created_at > ?
+            """, (key, now - self.ttl))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("UPDATE AIResponseCache SET last_used = ? WHERE cache_key = ?", (now, key))
+        
+        with self.lock:
+            if row:
+                self.counters["disk_hits"] += 1
+                self.remember(key, row[0], row[1])
+                return row[0]
+            self.counters["misses"] += 1
+        return None
+    
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.counters["writes"] += 1
+            self.remember(key, value, now)
+        
+        with db_cursor(immediate=True) as cursor:
+            cursor.execute("""
+                INSERT OR REPLACE INTO AIResponseCache (cache_key, response, size, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, value, len(value), now, now))
+            cursor.execute("DELETE FROM AIResponseCache WHERE created_at <= ?", (now - self.ttl,))
+            total = cursor.execute("SELECT IFNULL(SUM(size), 0) FROM AIResponseCache").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop least recently used entries until back under the cap
+                cursor.execute("""
+                    DELETE FROM AIResponseCache WHERE cache_key IN (
+                        SELECT cache_key FROM (
+                            SELECT cache_key, SUM(size) OVER (ORDER BY last_used DESC) AS running
+                            FROM AIResponseCache
+                        ) WHERE running > ?
+                    )
+                """, (self.max_bytes,))
+    
+    def remember(self, key, value, created_at):
+        # Caller holds self.lock
+        self.memory[key] = (value, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        with db_cursor() as cursor:
+            cursor.execute("DELETE FROM AIResponseCache")
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, memory_entries=len(self.memory))
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+@st.cache_resource
+def get_ai_cache():
+    return ResponseCache(
+        max_items=int(get_setting("BRAINWASH_AI_CACHE_ITEMS", "512")),
+        ttl=float(get_setting("BRAINWASH_AI_CACHE_TTL_HOURS", "168")) * 3600,
+        max_bytes=int(float(get_setting("BRAINWASH_AI_CACHE_MB", "50")) * 1024 * 1024),
+    )
+
+def ai_cache_key(kind, model, **fields):
+    """Cache key for a generation request answered by `model`; long inputs (PDF text, user context) are hashed"""
+    fields = {
+        name: hashlib.sha256(value.encode()).hexdigest() if isinstance(value, str) and len(value) > 200 else value
+        for name, value in fields.items()
+    }
+    payload = json.dumps({"kind": kind, "model": model, "prompt_version": PROMPT_VERSION, **fields}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def ai_cache_get(kind, fields, difficulty=None):
+    """A cached response to this request from any model it can be routed to, preferred models first"""
+    cache = get_ai_cache()
+    for model in get_model_router().route(kind, difficulty):
+        cached = cache.get(ai_cache_key(kind, model, **fields))
+        if cached:
+            return cached
+    return None
+
+def ai_cache_enabled(use_cache=True):
+    return use_cache and get_flag("BRAINWASH_AI_CACHE", default=True)
+
+class AIUnavailableError(Exception):
+    """A model call was refused before reaching the API (rate limit, open circuit or deadline)"""
+
+class SharedFlightError(AIUnavailableError):
+    """A call sharing another caller's request gave up on it (cancelled or too slow); running it alone may work"""
+
+class CircuitOpenError(AIUnavailableError):
+    """The model's circuit breaker refused the call; another model may still be tried"""
+
+class TokenBucket:
+    """Process-wide request rate limit: `rate` requests per second with bursts up to `capacity`"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, deadline):
+        """Take one token, waiting until `deadline` (monotonic) at most; False if none came in time"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """Fails calls fast after `threshold` consecutive failures.
+    
+    Once `cooldown` seconds have passed a single probe call is let through
+    (half-open); its outcome closes the circuit again or re-opens it.
+    """
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+    
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.probing or self.retry_in() == 0 else "open"
+    
+    def retry_in(self):
+        """Seconds until a probe may go through (0 when closed or due)"""
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+    
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or self.retry_in() > 0:
+                return False
+            self.probing = True
+            return True
+    
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.probing or self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+            self.probing = False
+
+def is_retryable_ai_error(error):
+    """Quota, overload and transport errors are worth retrying; bad requests are not"""
+    if isinstance(error, genai_errors.APIError):
+        return error.code in (408, 429, 500, 502, 503, 504)
+    return isinstance(error, httpx.TransportError)
+
+class AIGuard:
+    """Runs model calls under a shared rate limit, retries and per-model circuit breakers.
+    
+    Each call gets an overall deadline: waiting for the rate limit, attempts and
+    backoff sleeps all count against it, and every attempt's HTTP timeout is
+    capped by what is left.
+    """
+    
+    def __init__(self, rpm, burst, retries, deadline, attempt_timeout, breaker_failures, breaker_cooldown,
+                 base_backoff=1.0, max_backoff=20.0):
+        self.limiter = TokenBucket(rpm / 60, burst)
+        self.retries = retries
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0,
+            "throttled": 0, "breaker_rejections": 0, "deadline_exceeded": 0,
+        }
+        self.latency_total = 0.0
+    
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+    
+    def breaker(self, model):
+        with self.lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+            return self.breakers[model]
+    
+    def call(self, model, request, retries=None, deadline=None, timing=None):
+        """Return request(timeout_seconds), retrying retryable errors with jittered exponential backoff.
+        
+        `retries` and the absolute (monotonic) `deadline` default to the guard's
+        settings. When a `timing` dict is passed, timing["latency"] is set to
+        the seconds the successful attempt took, without rate-limit waits or
+        backoff. Raises AIUnavailableError when refused before reaching the
+        API, otherwise the last error from the API.
+        """
+        retries = self.retries if retries is None else retries
+        deadline = time.monotonic() + self.deadline if deadline is None else deadline
+        breaker = self.breaker(model)
+        for attempt in range(retries + 1):
+            if breaker.state == "open":
+                self.count("breaker_rejections")
+                raise CircuitOpenError(f"AI service is unavailable, retrying in {breaker.retry_in():.0f}s")
+            if not self.limiter.acquire(deadline):
+                self.count("throttled")
+                raise AIUnavailableError("Too many AI requests right now, please try again in a moment")
+            if not breaker.allow():
+                self.count("breaker_rejections")
+                raise CircuitOpenError("AI service is recovering, please try again in a moment")
+            self.count("calls")
+            started = time.monotonic()
+            try:
+                result = request(min(self.attempt_timeout, deadline - started))
+            except Exception as e:
+                retryable = is_retryable_ai_error(e)
+                breaker.record(not retryable)
+                self.count("failures")
+                if not retryable or attempt == retries:
+                    raise
+                # Full jitter keeps sessions that failed together from retrying together
+                delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    self.count("deadline_exceeded")
+                    raise
+                self.count("retries")
+                time.sleep(delay)
+            else:
+                latency = time.monotonic() - started
+                breaker.record(True)
+                with self.lock:
+                    self.counters["successes"] += 1
+                    self.latency_total += latency
+                if timing is not None:
+                    timing["latency"] = latency
+                return result
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            breakers = dict(self.breakers)
+            stats["avg_latency"] = self.latency_total / stats["successes"] if stats["successes"] else 0.0
+        stats["breakers"] = {model: breaker.state for model, breaker in breakers.items()}
+        return stats
+
+@st.cache_resource
+def get_ai_guard():
+    return AIGuard(
+        rpm=float(get_setting("BRAINWASH_AI_RPM", "60")),
+        burst=float(get_setting("BRAINWASH_AI_BURST", "10")),
+        retries=int(get_setting("BRAINWASH_AI_RETRIES", "3")),
+        deadline=float(get_setting("BRAINWASH_AI_DEADLINE", "90")),
+        attempt_timeout=float(get_setting("BRAINWASH_AI_TIMEOUT", "60")),
+        breaker_failures=int(get_setting("BRAINWASH_AI_BREAKER_FAILURES", "5")),
+        breaker_cooldown=float(get_setting("BRAINWASH_AI_BREAKER_COOLDOWN", "30")),
+    )
+
+class Flight:
+    """One shared model request and, once finished, its outcome"""
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+class SingleFlight:
+    """Lets concurrent callers with the same request key share one in-flight model call.
+    
+    Works across sessions because it lives in the process (see get_single_flight).
+    A successful outcome is kept for `window` seconds so callers that arrive
+    just after it finished reuse it too; failures are never kept. Callers
+    sharing a request wait at most `timeout` seconds for it (for each chunk
+    of a stream) and then raise SharedFlightError.
+    """
+    
+    def __init__(self, window):
+        self.window = window
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.counters = {"leader_calls": 0, "shared_calls": 0}
+    
+    def join(self, key):
+        """The flight for key and whether the caller must run it"""
+        now = time.monotonic()
+        with self.lock:
+            for stale in [k for k, f in self.flights.items() if f.finished_at and now - f.finished_at > self.window]:
+                del self.flights[stale]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            self.counters["leader_calls" if leader else "shared_calls"] += 1
+        return flight, leader
+    
+    def finish(self, key, flight, error=None):
+        with flight.cond:
+            flight.error = error
+            flight.finished_at = time.monotonic()
+            flight.cond.notify_all()
+        if error is not None:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+    
+    @staticmethod
+    def wait(flight, ready, timeout):
+        # Caller holds flight.cond
+        if not flight.cond.wait_for(ready, timeout):
+            raise SharedFlightError("The shared AI request took too long")
+    
+    def do(self, key, call, timeout=None):
+        """Return call(), or the result of an identical call already in flight"""
+        flight, leader = self.join(key)
+        if leader:
+            try:
+                flight.result = call()
+            except BaseException as e:
+                self.finish(key, flight, e)
+                raise
+            self.finish(key, flight)
+        else:
+            with flight.cond:
+                self.wait(flight, lambda: flight.finished_at is not None, timeout)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    
+    def stream(self, key, produce, timeout=None):
+        """Yield the chunks of produce(), sharing one stream among identical callers.
+        
+        Followers replay the chunks received so far, then follow live.
+        """
+        flight, leader = self.join(key)
+        if leader:
+            try:
+                for chunk in produce():
+                    with flight.cond:
+                        flight.chunks.append(chunk)
+                        flight.cond.notify_all()
+                    yield chunk
+            except GeneratorExit:
+                self.finish(key, flight, SharedFlightError("The shared AI request was cancelled"))
+                raise
+            except BaseException as e:
+                self.finish(key, flight, e)
+                raise
+            self.finish(key, flight)
+            return
+        sent = 0
+        while True:
+            with flight.cond:
+                self.wait(flight, lambda: sent < len(flight.chunks) or flight.finished_at is not None, timeout)
+                chunks = flight.chunks[sent:]
+                finished = flight.finished_at is not None
+            yield from chunks
+            sent += len(chunks)
+            if finished:
+                break
+        if flight.error is not None:
+            raise flight.error
+    
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, flights=len(self.flights))
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight(window=float(get_setting("BRAINWASH_AI_COALESCE_WINDOW", "5")))
+
+def ai_request_key(prompt, is_json, mode, kind, difficulty):
+    """Single-flight key: route (kind and difficulty pick the model), output config and normalized prompt"""
+    payload = json.dumps({
+        "kind": kind, "difficulty": difficulty, "json": is_json, "mode": mode, "prompt": " ".join(prompt.split()),
+    })
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def ai_coalesce_enabled(coalesce=True):
+    return coalesce and get_flag("BRAINWASH_AI_COALESCE", default=True)
+
+DEFAULT_MODEL_ROUTES = {
+    "default": [AI_MODEL, "gemini-2.5-flash-lite"],
+    "task:Easy": ["gemini-2.5-flash-lite", AI_MODEL],
+    "grade:Easy": ["gemini-2.5-flash-lite", AI_MODEL],
+}
+
+def hardest_difficulty(difficulties):
+    return max(difficulties, key=TASK_DIFFICULTIES.index, default=None)
+
+class ModelRouter:
+    """Picks models per call type and difficulty, steering away from slow or failing ones.
+    
+    Routes map "kind:difficulty", "kind" or "default" to models in order of
+    preference. Latency (p50/p95) and error rate are tracked per model over
+    the last `horizon` seconds; a model whose p95 is above `slow_p95` or whose
+    error rate is above `max_error_rate` moves to the back until it recovers.
+    """
+    
+    def __init__(self, routes, slow_p95, max_error_rate, horizon=300, min_samples=5):
+        self.routes = routes
+        self.slow_p95 = slow_p95
+        self.max_error_rate = max_error_rate
+        self.horizon = horizon
+        self.min_samples = min_samples
+        self.samples = {}  # model -> deque of (time, latency or None, ok)
+        self.lock = threading.Lock()
+        self.counters = {"fallbacks": 0}
+    
+    def route(self, kind, difficulty=None):
+        models = self.routes.get(f"{kind}:{difficulty}") or self.routes.get(kind) or self.routes["default"]
+        healthy = [model for model in models if self.healthy(model)]
+        return healthy + [model for model in models if model not in healthy]
+    
+    def record(self, model, latency, ok):
+        """Log one call; latency None for calls whose duration isn't comparable (streams)"""
+        with self.lock:
+            self.samples.setdefault(model, deque(maxlen=200)).append((time.monotonic(), latency, ok))
+    
+    def model_stats(self, model):
+        cutoff = time.monotonic() - self.horizon
+        with self.lock:
+            samples = [sample for sample in self.samples.get(model, ()) if sample[0] >= cutoff]
+        latencies = sorted(latency for _, latency, ok in samples if ok and latency is not None)
+        percentile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+        return {
+            "calls": len(samples),
+            "error_rate": sum(not ok for _, _, ok in samples) / len(samples) if samples else 0.0,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+        }
+    
+    def healthy(self, model):
+        stats = self.model_stats(model)
+        if stats["calls"] < self.min_samples:
+            return True
+        return stats["error_rate"] <= self.max_error_rate and (stats["p95"] is None or stats["p95"] <= self.slow_p95)
+    
+    def call(self, kind, difficulty, request, guard, timed=True):
+        """Return request(model, timeout) from the first routed model that succeeds.
+        
+        Every model but the last gets a single attempt so a failing one hands
+        over at once; all of them share one deadline. Rate limiting is not a
+        model problem, so it is raised straight away.
+        """
+        models = self.route(kind, difficulty)
+        deadline = time.monotonic() + guard.deadline
+        for n, model in enumerate(models):
+            last = n == len(models) - 1
+            timing = {}
+            try:
+                result = guard.call(model, functools.partial(request, model), retries=None if last else 0, deadline=deadline, timing=timing)
+            except CircuitOpenError:
+                if last:
+                    raise
+            except AIUnavailableError:
+                raise
+            except Exception:
+                self.record(model, None, ok=False)
+                if last:
+                    raise
+            else:
+                self.record(model, timing["latency"] if timed else None, ok=True)
+                return result
+            with self.lock:
+                self.counters["fallbacks"] += 1
+    
+    def stats(self):
+        with self.lock:
+            models = list(self.samples)
+        return {model: dict(self.model_stats(model), healthy=self.healthy(model)) for model in models}
+
+@st.cache_resource
+def get_model_router():
+    routes = get_setting("BRAINWASH_AI_MODEL_ROUTES")
+    return ModelRouter(
+        routes={**DEFAULT_MODEL_ROUTES, **(json.loads(routes) if isinstance(routes, str) else dict(routes or {}))},
+        slow_p95=float(get_setting("BRAINWASH_AI_SLOW_P95", "20")),
+        max_error_rate=float(get_setting("BRAINWASH_AI_MAX_ERROR_RATE", "0.5")),
+    )
+
+def generation_config(is_json=False, timeout=None):
+    return types.GenerateContentConfig(
         temperature=0.7,
-        response_mime_type="application/json" if is_json else "text/plain"
+        response_mime_type="application/json" if is_json else "text/plain",
+        http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None
     )
+
+def get_ai_response(prompt, is_json=False, coalesce=True, kind="default", difficulty=None, served=None, errors=None):
+    """Model response text, or None on failure (shown to the user, or collected
+    in `errors` off the script thread; see report_ai_error).
+    
+    The model is routed by call `kind` and task `difficulty`; the one that
+    answered is stored in served["model"] when a dict is passed. Identical
+    concurrent calls share one request unless coalesce=False, which calls
+    meant to produce something new (fresh tasks) must pass.
+    """
+    client = get_ai_client(errors)
+    if not client: return None
+    
+    def call():
+        return get_model_router().call(kind, difficulty, lambda model, timeout: (model, client.models.generate_content(
+            model=model, contents=prompt, config=generation_config(is_json, timeout)
+        ).text), get_ai_guard())
+    
+    try:
+        if ai_coalesce_enabled(coalesce):
+            model, text = get_single_flight().do(ai_request_key(prompt, is_json, "text", kind, difficulty), call, get_ai_guard().deadline)
+        else:
+            model, text = call()
+        if served is not None:
+            served["model"] = model
+        return text
+    except AIUnavailableError as e:
+        report_ai_error("warning", f"⏳ {e}", errors)
+        return None
+    except Exception as e:
+        report_ai_error("error", f"AI Error: {e}", errors)
+        return None
+
+def get_ai_response_stream(prompt, is_json=False, coalesce=True, kind="default", difficulty=None, served=None):
+    """Like get_ai_response, but yields the response text chunk by chunk as it arrives.
+    
+    Only opening the stream (up to the first chunk) is retried. served["model"]
+    is only set for the caller that ran the stream, not for ones sharing it.
+    A shared stream that is cut off raises SharedFlightError so the caller
+    can retry on its own.
+    """
+    client = get_ai_client()
+    if not client: return
+    
+    def open_stream(model, timeout):
+        stream = iter(client.models.generate_content_stream(
+            model=model, contents=prompt, config=generation_config(is_json, timeout)
+        ))
+        first = next(stream, None)
+        if served is not None:
+            served["model"] = model
+        return stream, first
+    
+    def chunks():
+        stream, chunk = get_model_router().call(kind, difficulty, open_stream, get_ai_guard(), timed=False)
+        while chunk is not None:
+            if chunk.text:
+                yield chunk.text
+            chunk = next(stream, None)
+    
     try:
-        response = client.models.generate_content(model=model_id, contents=prompt, config=config)
-        return response.text
+        if ai_coalesce_enabled(coalesce):
+            yield from get_single_flight().stream(ai_request_key(prompt, is_json, "stream", kind, difficulty), chunks, get_ai_guard().deadline)
+        else:
+            yield from chunks()
+    except SharedFlightError:
+        raise
+    except AIUnavailableError as e:
+        st.warning(f"⏳ {e}")
     except Exception as e:
         st.error(f"AI Error: {e}")
+
+class TaskStreamParser:
+    """Incremental parser for a streamed `{"tasks": [...]}` response.
+    
+    feed() takes the next chunk of text and returns the task objects it
+    completed. Malformed JSON raises ValueError as soon as it is seen rather
+    than when the stream ends.
+    """
+    
+    def __init__(self):
+        self.buffer = ""
+        self.pos = None  # scan position inside the tasks array, once found
+        self.start = None  # where the task object being read began
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+    
+    def feed(self, text):
+        self.buffer += text
+        tasks = []
+        if self.pos is None:
+            head = self.buffer.lstrip()
+            if head and head[0] not in "{[":
+                raise ValueError(f"Expected a JSON object, got {head[:20]!r}")
+            match = re.search(r'"tasks"\s*:\s*\[', self.buffer)
+            if match:
+                self.pos = match.end()
+            elif head.startswith("["):
+                self.pos = self.buffer.index("[") + 1
+            else:
+                return tasks
+        while not self.done and self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if self.start is None:
+                if char == "{":
+                    self.start, self.depth = self.pos, 1
+                elif char == "]":
+                    self.done = True
+                elif not (char.isspace() or char == ","):
+                    raise ValueError(f"Unexpected {char!r} in tasks array")
+            elif self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    tasks.append(json.loads(self.buffer[self.start:self.pos + 1]))
+                    self.start = None
+            self.pos += 1
+        return tasks
+
+# Local pre-grading: answers whose verdict is obvious from the stored solution skip the model
+# Numbers this close (relative) that still don't match are left to the model: rounding, units or a slip
+ANSWER_NEAR_MISS = 0.1
+ANSWER_NUMBER = r"[-+]?(?:(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d*))?|\.(\d+))(?:e([-+]?\d+))?"
+
+def normalize_answer(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = re.sub(r"^\s*(the answer is|answer:|it is|it's)\s*", "", text)
+    text = re.sub(r"\s*([=+*/^()<>-])\s*", r"\1", text)
+    # Only trailing punctuation: a leading "." is a decimal point
+    return re.sub(r"\s+", " ", text).strip().rstrip(" .!;:")
+
+def parse_number(text):
+    """(value, is_percent, step) of an answer that is exactly one number, fraction or `x=number`; None otherwise.
+    
+    step is one unit in the last stated decimal place ("3.14" -> 0.01), or 0
+    for integers and fractions, which are exact. Anything holding more than
+    one value ("x=3, y=4", "x=2 or x=3") is not a number.
+    """
+    match = re.fullmatch(rf"(?:[a-z]\w*=)?(?:({ANSWER_NUMBER})|([-+]?\d+)/(\d+))(%?)", text)
+    if not match:
+        return None
+    if match.group(1):
+        value = float(match.group(1).replace(",", ""))
+        decimals = len(match.group(2) or match.group(3) or "")
+        step = 10.0 ** (int(match.group(4) or 0) - decimals) if decimals else 0.0
+    elif int(match.group(6)):
+        value, step = int(match.group(5)) / int(match.group(6)), 0.0
+    else:
+        return None
+    return value, bool(match.group(7)), step
+
+def graded_locally(score, feedback):
+    """A local verdict in the same shape check_answer gets from the model"""
+    return {
+        "is_correct": score >= 90,
+        "score": score,
+        "feedback": feedback,
+        "status": "correct" if score >= 90 else "partial" if score >= 60 else "incorrect",
+        "graded_by": "local",
+    }
+
+def pre_grade_answer(solution, user_answer):
+    """Grade without the model when the verdict can't be wrong; None otherwise.
+    
+    Only empty answers, exact matches after normalization and answers that are
+    a single number are graded here. A number is right if it equals the
+    solution to the solution's stated decimal places (integers exactly) and
+    wrong if it is off by more than ANSWER_NEAR_MISS; near misses go to the
+    model. Anything else, however close it looks, goes to the model too: a
+    sign, exponent or operator changes a formula's meaning without changing
+    much of its text.
+    """
+    answer, expected = normalize_answer(user_answer), normalize_answer(solution)
+    if not answer:
+        return graded_locally(0, "No answer given.")
+    if not expected:
         return None
+    if answer == expected:
+        return graded_locally(100, "Exactly right!")
+    
+    expected_number, answer_number = parse_number(expected), parse_number(answer)
+    if expected_number is None or answer_number is None:
+        return None
+    (expected_value, expected_percent, step), (answer_value, answer_percent, _) = expected_number, answer_number
+    # Half a unit in the last stated place; the float slack only absorbs representation error
+    same = lambda a, b, step: abs(a - b) <= step / 2 + 1e-9 * max(abs(a), abs(b), 1)
+    if expected_percent == answer_percent:
+        if same(expected_value, answer_value, step):
+            return graded_locally(100, "Correct value!")
+        if math.isclose(expected_value, answer_value, rel_tol=ANSWER_NEAR_MISS):
+            return None
+        return graded_locally(0, "That value doesn't match the expected answer.")
+    # "50%" and "0.5" are the same value, and "50" may mean 50% too; any other mismatch is the model's call
+    if expected_percent:
+        matches = same(expected_value / 100, answer_value, step / 100) or same(expected_value, answer_value, step)
+    else:
+        matches = same(expected_value, answer_value / 100, step) or same(expected_value, answer_value, step)
+    return graded_locally(100, "Correct value!") if matches else None
+
+class GradingStats:
+    """Process-wide count of answers graded locally versus by the model"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"local": 0, "model": 0}
+    
+    def record(self, local):
+        with self.lock:
+            self.counters["local" if local else "model"] += 1
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        graded = stats["local"] + stats["model"]
+        stats["avoided_share"] = stats["local"] / graded if graded else 0.0
+        return stats
 
-def check_answer(task_text, solution, user_answer):
-    """Use AI to check if user's answer is correct"""
+@st.cache_resource
+def get_grading_stats():
+    return GradingStats()
+
+def check_answer(task_text, solution, user_answer, difficulty=None):
+    """Check the user's answer: locally when the verdict is obvious, otherwise with AI"""
+    local = pre_grade_answer(solution, user_answer)
+    get_grading_stats().record(local is not None)
+    if local:
+        return local
+    
     prompt = f"""
     Task: {task_text}
     Expected Solution: {solution}
@@ -550,7 +1954,7 @@ def check_answer(task_text, solution, user_answer):
     - 0-59: Incorrect
     """
     
-    res = get_ai_response(prompt, is_json=True)
+    res = get_ai_response(prompt, is_json=True, kind="grade", difficulty=difficulty)
     if res:
         try:
             return json.loads(res)
@@ -563,11 +1967,429 @@ def check_answer(task_text, solution, user_answer):
             }
     return None
 
-def get_initial_plan(subject, topic, context="", user_context=""):
-    prompt = f"""
+# PDF cache: extracted text and chunk indexes on disk, keyed by content hash
+def hash_upload(upload, block_size=1 << 20):
+    """SHA-256 of a file-like upload, read in blocks; the position is rewound afterwards"""
+    digest = hashlib.sha256()
+    upload.seek(0)
+    for block in iter(lambda: upload.read(block_size), b""):
+        digest.update(block)
+    upload.seek(0)
+    return digest.hexdigest()
+
+class PdfCache:
+    """Directory of PDF extraction results (.json) and BM25 indexes (.npz) named by content hash.
+    
+    Files are written atomically (temp file + rename), so any number of
+    sessions and server processes can share one directory. Reads refresh a
+    file's mtime; past max_bytes the least recently used files are deleted.
+    """
+    
+    def __init__(self, root, max_bytes=200 * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+    
+    def read(self, name, load):
+        path = self.root / name
+        try:
+            value = load(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):  # Missing, evicted meanwhile, unreadable or truncated
+            value = None
+        with self.lock:
+            self.counters["hits" if value is not None else "misses"] += 1
+        return value
+    
+    def write(self, name, save):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.root, suffix=".tmp", delete=False) as out:
+            try:
+                save(out)
+            except BaseException:
+                out.close()
+                os.unlink(out.name)
+                raise
+        os.replace(out.name, self.root / name)
+        with self.lock:
+            self.counters["writes"] += 1
+        self.evict()
+    
+    def evict(self):
+        files = []
+        for path in self.root.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if not path.is_file():
+                continue  # The blob store lives in a subdirectory and collects itself
+            if path.suffix == ".tmp" and time.time() - stat.st_mtime < 3600:
+                continue  # Another process may still be writing it
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files, key=lambda item: item[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            with self.lock:
+                self.counters["evictions"] += 1
+    
+    def get_extraction(self, key):
+        """(blob key, report) of a PDF extracted earlier under key, or None"""
+        def load(path):
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            return entry["blob"], entry["report"]  # KeyError (a miss) for entries that still hold the text itself
+        return self.read(f"{key}.json", load)
+    
+    def put_extraction(self, key, blob_key, report):
+        self.write(f"{key}.json", lambda out: out.write(json.dumps({"blob": blob_key, "report": report}).encode("utf-8")))
+    
+    def get_index(self, blob_key):
+        return self.read(f"{blob_key}.bm25.npz", BM25Index.load)
+    
+    def put_index(self, blob_key, index):
+        self.write(f"{blob_key}.bm25.npz", index.save)
+    
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+@st.cache_resource
+def get_pdf_workers():
+    """Worker processes that parse PDFs, shared by every session"""
+    return PdfWorkerPool(
+        workers=int(get_setting("BRAINWASH_PDF_WORKERS", "2")),
+        memory_limit=int(float(get_setting("BRAINWASH_PDF_MEMORY_MB", "1024")) * 1024 * 1024),
+    )
+
+class BlobStore:
+    """Content-addressed text files, read through shared memory maps.
+    
+    A blob is named by the SHA-256 of its UTF-8 bytes, so identical documents
+    share one file and sessions keep only the key (in a BlobRef). collect(),
+    run every collect_interval seconds on a background thread, unmaps blobs
+    no BlobRef in this process points to (e.g. their sessions ended) and
+    deletes those no process has used for lease_seconds; reads and
+    collections refresh a blob's mtime.
+    """
+    
+    def __init__(self, root, lease_seconds=24 * 3600, collect_interval=600):
+        self.root = Path(root)
+        self.lease_seconds = lease_seconds
+        self.collect_interval = collect_interval
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.touched = {}
+        self.refs = weakref.WeakSet()
+        self.counters = {"blobs_written": 0, "blobs_collected": 0}
+        self.collector = threading.Thread(target=self.run, name="brainwash-blob-gc", daemon=True)
+        self.collector.start()
+    
+    def path(self, key):
+        return self.root / f"{key}.txt"
+    
+    def put(self, text):
+        """Store text (if not already there) and return a BlobRef to it"""
+        data = text.encode("utf-8")
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        if path.exists():
+            os.utime(path)
+        else:
+            self.root.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.root, suffix=".tmp", delete=False) as out:
+                out.write(data)
+            os.replace(out.name, path)
+            with self.lock:
+                self.counters["blobs_written"] += 1
+        return self.open(key)
+    
+    def open(self, key):
+        """A BlobRef to an existing blob; raises FileNotFoundError once it has been collected"""
+        self.view(key)
+        ref = BlobRef(self, key)
+        with self.lock:
+            self.refs.add(ref)
+        return ref
+    
+    def view(self, key):
+        """Read-only map of a blob's bytes, shared by every reader in this process"""
+        with self.lock:
+            view = self.maps.get(key)
+            if view is None:
+                with open(self.path(key), "rb") as blob:
+                    # mmap can't map an empty file (e.g. a scanned PDF with no text layer)
+                    view = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(blob.fileno()).st_size else b""
+                self.maps[key] = view
+            now = time.time()
+            if now - self.touched.get(key, 0) > 60:
+                # Renew the lease so other processes' collect() leaves the blob alone
+                self.touched[key] = now
+                try:
+                    os.utime(self.path(key))
+                except FileNotFoundError:  # Collected elsewhere; this process still has it mapped
+                    pass
+        return view
+    
+    def run(self):
+        while True:
+            time.sleep(self.collect_interval)
+            try:
+                self.collect()
+            except Exception:
+                print("Blob collection failed:", file=sys.stderr)
+                traceback.print_exc()
+    
+    def collect(self):
+        """Delete blobs nobody uses any more and unmap ones this process no longer references"""
+        now = time.time()
+        with self.lock:
+            live = {ref.key for ref in self.refs}
+            for key in list(self.maps):
+                if key not in live:
+                    view = self.maps.pop(key)
+                    self.touched.pop(key, None)
+                    if isinstance(view, mmap.mmap):
+                        view.close()
+        if not self.root.is_dir():
+            return
+        for path in self.root.iterdir():
+            key = path.name.split(".")[0]
+            try:
+                if key in live:
+                    os.utime(path)
+                elif now - path.stat().st_mtime > self.lease_seconds:
+                    path.unlink()
+                    with self.lock:
+                        self.counters["blobs_collected"] += 1
+            except FileNotFoundError:  # Removed by another process meanwhile
+                continue
+    
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, mapped=len(self.maps), referenced=len({ref.key for ref in self.refs}))
+
+class BlobRef:
+    """What a session holds instead of a document's text: the blob key, with reads by byte offset"""
+    
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+    
+    def bytes(self):
+        """The whole blob as a read-only buffer (no copy)"""
+        return self.store.view(self.key)
+    
+    def read(self, start=0, end=None):
+        return self.store.view(self.key)[start:end].decode("utf-8", errors="replace")
+
+@st.cache_resource
+def get_blob_store():
+    return BlobStore(
+        get_setting("BRAINWASH_PDF_BLOB_DIR", str(Path(get_setting("BRAINWASH_PDF_CACHE_DIR", ".brainwash_cache")) / "blobs")),
+        lease_seconds=float(get_setting("BRAINWASH_PDF_BLOB_LEASE_HOURS", "24")) * 3600,
+    )
+
+def utf8_offsets(text, offsets):
+    """Byte positions in text's UTF-8 encoding of ascending character offsets"""
+    positions, position, previous = [], 0, 0
+    for offset in offsets:
+        position += len(text[previous:offset].encode("utf-8"))
+        previous = offset
+        positions.append(position)
+    return positions
+
+@st.cache_resource
+def get_pdf_cache():
+    return PdfCache(
+        get_setting("BRAINWASH_PDF_CACHE_DIR", ".brainwash_cache"),
+        max_bytes=int(float(get_setting("BRAINWASH_PDF_CACHE_MB", "200")) * 1024 * 1024),
+    )
+
+def read_pdf(upload, page_range="", max_chars=300_000, time_budget=15.0):
+    """extract_pdf_text() behind the PDF cache: an upload seen before (by anyone) is not parsed again.
+    
+    Returns (BlobRef, report): the text goes to the blob store rather than the
+    session, and the report's page_offsets are byte offsets into the blob.
+    Parsing runs in worker processes (see pdf_extract); reads the clock or a
+    failing page stopped short are not cached, so a later upload can get further.
+    """
+    started = time.perf_counter()
+    key = hashlib.sha256(json.dumps({
+        "pdf": hash_upload(upload),
+        "pages": re.sub(r"\s+", "", page_range),
+        "max_chars": max_chars,
+    }).encode()).hexdigest()
+    cache = get_pdf_cache()
+    cached = cache.get_extraction(key)
+    if cached:
+        blob_key, report = cached
+        try:
+            blob = get_blob_store().open(blob_key)
+        except FileNotFoundError:  # The text was collected since; extract again
+            pass
+        else:
+            return blob, dict(report, cached=True, seconds=time.perf_counter() - started)
+    pool = get_pdf_workers()
+    text, report = extract_pdf_text(
+        upload,
+        pool,
+        page_range,
+        max_chars=max_chars,
+        time_budget=max(time_budget - (time.perf_counter() - started), 1.0),
+        parallel=pool.workers,
+        job_timeout=float(get_setting("BRAINWASH_PDF_JOB_TIMEOUT", "30")),
+    )
+    # The chunk index splits words on ASCII whitespace only (it scans the blob's bytes); NBSP and
+    # friends become plain spaces, one character for one, so character offsets stay valid
+    text = re.sub(r"[^\S\t\n\r\f\v ]", " ", text)
+    pages, offsets = zip(*report["page_offsets"]) if report["page_offsets"] else ((), ())
+    report["page_offsets"] = list(zip(pages, utf8_offsets(text, offsets)))
+    blob = get_blob_store().put(text)
+    if not report["timed_out"] and not report["error"]:
+        cache.put_extraction(key, blob.key, report)
+    return blob, dict(report, cached=False)
+
+# PDF retrieval: only the chunks most relevant to the mission go into prompts
+CHUNK_WORDS = 180
+CHUNK_OVERLAP_WORDS = 30
+CHARS_PER_TOKEN = 4
+RETRIEVAL_STOPWORDS = frozenset("""
+    a an and are as at be by for from has have in is it its of on or that the this to was were will with
+    pdf chapter lecture notes part unit
+""".split())
+
+def retrieval_tokens(text):
+    return [token for token in re.findall(r"[a-z0-9]+", text.lower()) if token not in RETRIEVAL_STOPWORDS and len(token) > 1]
+
+class BM25Index:
+    """Okapi BM25 over overlapping word-window chunks of a UTF-8 document.
+    
+    Only chunk byte offsets and the postings (as flat NumPy arrays sorted by
+    term) are kept, so the index is small next to the text it covers and
+    chunks can be sliced straight out of a memory-mapped blob.
+    """
+    
+    def __init__(self, data, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        words = [match.span() for match in re.finditer(rb"\S+", data)]
+        stride = CHUNK_WORDS - CHUNK_OVERLAP_WORDS
+        self.spans = [
+            (words[start][0], words[min(start + CHUNK_WORDS, len(words)) - 1][1])
+            for start in range(0, max(len(words) - CHUNK_OVERLAP_WORDS, 1), stride)
+        ] if words else []
+        self.vocabulary = {}
+        postings = []
+        lengths = []
+        for chunk_id, (start, end) in enumerate(self.spans):
+            tokens = retrieval_tokens(bytes(data[start:end]).decode("utf-8", errors="replace"))
+            lengths.append(len(tokens))
+            term_ids, counts = np.unique(
+                np.array([self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens], dtype=np.int64),
+                return_counts=True
+            )
+            postings.append(np.stack([term_ids, np.full_like(term_ids, chunk_id), counts]))
+        postings = np.concatenate(postings, axis=1) if postings else np.zeros((3, 0), dtype=np.int64)
+        order = np.argsort(postings[0], kind="stable")
+        self.term_ids, self.chunk_ids, self.counts = postings[:, order]
+        self.lengths = np.array(lengths, dtype=np.float64)
+        self.average_length = self.lengths.mean() if len(lengths) else 0.0
+        document_frequency = np.bincount(self.term_ids, minlength=len(self.vocabulary))
+        self.idf = np.log1p((len(self.spans) - document_frequency + 0.5) / (document_frequency + 0.5))
+    
+    def scores(self, query):
+        scores = np.zeros(len(self.spans))
+        norms = self.k1 * (1 - self.b + self.b * self.lengths / max(self.average_length, 1.0))
+        for term_id in {self.vocabulary[token] for token in retrieval_tokens(query) if token in self.vocabulary}:
+            start, end = np.searchsorted(self.term_ids, [term_id, term_id + 1])
+            chunks, counts = self.chunk_ids[start:end], self.counts[start:end]
+            scores[chunks] += self.idf[term_id] * counts * (self.k1 + 1) / (counts + norms[chunks])
+        return scores
+    
+    def rank(self, query):
+        """Chunk ids, most relevant first (ties keep document order)"""
+        return np.argsort(-self.scores(query), kind="stable")
+    
+    def save(self, out):
+        np.savez(
+            out, k1=self.k1, b=self.b, spans=np.array(self.spans, dtype=np.int64).reshape(-1, 2),
+            vocabulary=np.array(list(self.vocabulary), dtype=str), term_ids=self.term_ids,
+            chunk_ids=self.chunk_ids, counts=self.counts, lengths=self.lengths, idf=self.idf
+        )
+    
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        with np.load(path, allow_pickle=False) as data:
+            index.k1, index.b = float(data["k1"]), float(data["b"])
+            index.spans = data["spans"].tolist()
+            index.vocabulary = {term: term_id for term_id, term in enumerate(data["vocabulary"].tolist())}
+            index.term_ids, index.chunk_ids, index.counts = data["term_ids"], data["chunk_ids"], data["counts"]
+            index.lengths, index.idf = data["lengths"], data["idf"]
+        index.average_length = index.lengths.mean() if len(index.lengths) else 0.0
+        return index
+
+@st.cache_resource(max_entries=16)
+def get_chunk_index(blob_key, _blob):
+    """BM25 index of a blob, shared by every session (and, via the PDF cache, process) with the same text"""
+    cache = get_pdf_cache()
+    index = cache.get_index(blob_key)
+    if index is None:
+        index = BM25Index(_blob.bytes())
+        cache.put_index(blob_key, index)
+    return index
+
+class ChunkRotation:
+    """Hands out a document's most relevant chunks, a token budget at a time.
+    
+    Each call continues down the relevance ranking (wrapping around at the
+    end), so successive tasks for one PDF draw on different material. The
+    text stays in the blob store; only the chunks handed out are read.
+    """
+    
+    def __init__(self, blob, query):
+        self.blob = blob
+        self.index = get_chunk_index(blob.key, blob)
+        self.ranking = self.index.rank(query).tolist()
+        self.position = 0
+        self.lock = threading.Lock()
+    
+    def next(self, budget_tokens):
+        budget = budget_tokens * CHARS_PER_TOKEN
+        with self.lock:
+            chosen = []
+            for _ in range(len(self.ranking)):
+                chunk_id = self.ranking[self.position % len(self.ranking)]
+                start, end = self.index.spans[chunk_id]
+                if chosen and budget < end - start:
+                    break
+                chosen.append(chunk_id)
+                budget -= end - start
+                self.position += 1
+        # Document order reads better than relevance order
+        return "\n[...]\n".join(self.blob.read(*self.index.spans[chunk_id])[:budget_tokens * CHARS_PER_TOKEN] for chunk_id in sorted(chosen))
+
+def plan_cache_fields(subject, topic, context, user_context):
+    return dict(
+        subject=subject.strip().lower(),
+        topic=topic.strip().lower(),
+        user_context=hashlib.sha256(user_context.encode()).hexdigest(),
+        context=hashlib.sha256(context.encode()).hexdigest()
+    )
+
+def plan_prompt(subject, topic, context, user_context):
+    """Prompt for a 5-task plan; `context` is expected to be budgeted already (see ChunkRotation)"""
+    return f"""
     Create a personalized study plan for {subject}: {topic}. 
     {f'User learning context: {user_context}' if user_context else ''}
-    {f'Material context: {context[:5000]}' if context else ''}
+    {f'Material context: {context}' if context else ''}
     Return exactly 5 tasks (1 Hard, 2 Medium, 2 Easy).
     Each task MUST have a brief "solution".
     Return ONLY JSON:
@@ -579,13 +2401,342 @@ def get_initial_plan(subject, topic, context="", user_context=""):
         {{"text": "Task...", "difficulty": "Easy", "xp": 50, "solution": "..."}}
     ] }}
     """
-    res = get_ai_response(prompt, is_json=True)
-    return json.loads(res) if res else None
 
-def get_new_task_json(subject, topic, diff, user_context=""):
-    prompt = f"Create one new {diff} study task for {subject}: {topic}. {f'User context: {user_context}' if user_context else ''} Include a brief solution. Return ONLY JSON: {{'text': '...', 'solution': '...'}}"
-    res = get_ai_response(prompt, is_json=True)
-    return json.loads(res) if res else {"text": "Review materials", "solution": "No solution available."}
+def check_answers(items, difficulty=None):
+    """Grade several (task_text, solution, user_answer) items with at most one model call.
+    
+    Obvious answers are graded locally; the rest go to the model together,
+    routed for `difficulty` (the hardest task among them).
+    Returns one result per item, in order, with None where no verdict came back.
+    """
+    results = [pre_grade_answer(solution, user_answer) for _, solution, user_answer in items]
+    stats = get_grading_stats()
+    for result in results:
+        stats.record(result is not None)
+    pending = [n for n, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    
+    answers = "\n".join(
+        f"""
+    Answer {number}:
+    Task: {items[n][0]}
+    Expected Solution: {items[n][1]}
+    User's Answer: {items[n][2]}"""
+        for number, n in enumerate(pending, 1)
+    )
+    prompt = f"""
+    Evaluate each numbered answer below: is it correct or close to its expected solution?
+    {answers}
+    
+    Return ONLY JSON with one result per answer:
+    {{ "results": [
+        {{"answer": 1, "is_correct": true/false, "score": 0-100, "feedback": "brief feedback message", "status": "correct"/"partial"/"incorrect"}}
+    ] }}
+    
+    Score guidelines:
+    - 90-100: Fully correct
+    - 60-89: Partially correct
+    - 0-59: Incorrect
+    """
+    res = get_ai_response(prompt, is_json=True, kind="grade", difficulty=difficulty)
+    try:
+        graded = json.loads(res)['results'] if res else []
+    except (json.JSONDecodeError, KeyError, TypeError):
+        graded = []
+    for entry in graded if isinstance(graded, list) else []:
+        try:
+            number, score = int(entry['answer']), max(0, min(100, int(entry['score'])))
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 1 <= number <= len(pending):
+            continue
+        n = pending[number - 1]
+        results[n] = {
+            "is_correct": score >= 90,
+            "score": score,
+            "feedback": str(entry.get('feedback', '')),
+            "status": entry.get('status') if entry.get('status') in ("correct", "partial", "incorrect")
+                      else "correct" if score >= 90 else "partial" if score >= 60 else "incorrect",
+        }
+    return results
+
+def get_initial_plan(subject, topic, context="", user_context="", use_cache=True):
+    use_cache = ai_cache_enabled(use_cache)
+    cache_fields = plan_cache_fields(subject, topic, context, user_context)
+    if use_cache:
+        cached = ai_cache_get("plan", cache_fields)
+        if cached:
+            return json.loads(cached)
+    
+    served = {}
+    res = get_ai_response(plan_prompt(subject, topic, context, user_context), is_json=True, kind="plan", served=served)
+    if not res:
+        return None
+    plan = json.loads(res)
+    if use_cache and plan.get('tasks'):
+        get_ai_cache().put(ai_cache_key("plan", served["model"], **cache_fields), res)
+    return plan
+
+def stream_initial_plan(subject, topic, context="", user_context="", use_cache=True):
+    """Yield the plan's tasks one by one as the model streams them.
+    
+    A malformed or invalid task, a stream that ends early or a shared stream
+    cut off by the session running it aborts the stream and a retry starts
+    (uncoalesced, so it cannot replay the bad stream). The retry is a
+    different plan, so only tasks of the difficulties still missing from
+    PLAN_MIX are taken from it. Slots still empty after that are filled with
+    one generate_tasks call; a plan that can't be completed is reported to
+    the user. The plan is cached only once complete.
+    """
+    use_cache = ai_cache_enabled(use_cache)
+    cache_fields = plan_cache_fields(subject, topic, context, user_context)
+    if use_cache:
+        cached = ai_cache_get("plan", cache_fields)
+        if cached:
+            yield from json.loads(cached)['tasks']
+            return
+    
+    prompt = plan_prompt(subject, topic, context, user_context)
+    tasks = []
+    missing = dict(PLAN_MIX)
+    served = {}
+    error = None
+    
+    def take(task):
+        if missing.get(task['difficulty']) and task['text'] not in {t['text'] for t in tasks}:
+            missing[task['difficulty']] -= 1
+            task.setdefault('xp', TASK_XP[task['difficulty']])
+            tasks.append(task)
+            return True
+        return False
+    
+    for attempt in range(1 + PLAN_STREAM_RETRIES):
+        parser = TaskStreamParser()
+        try:
+            for chunk in get_ai_response_stream(prompt, is_json=True, coalesce=attempt == 0, kind="plan", served=served):
+                for task in parser.feed(chunk):
+                    if not is_valid_task(task):
+                        raise ValueError(f"Invalid task in plan: {task!r}")
+                    if take(task):
+                        yield task
+            if not parser.done:
+                raise ValueError("the response was cut off")
+        except (ValueError, SharedFlightError) as e:
+            error = e
+            continue
+        break
+    
+    if tasks and any(missing.values()):
+        difficulties = [diff for diff, count in missing.items() for _ in range(count)]
+        for task in generate_tasks(subject, topic, difficulties, user_context, context):
+            if take(task):
+                yield task
+    if not tasks:
+        st.error(f"Couldn't create a study plan{f' ({error})' if error else ''}. Please try again.")
+    elif any(missing.values()):
+        st.warning(f"The plan came back with only {len(tasks)} of {sum(PLAN_MIX.values())} tasks.")
+    # Callers that shared another session's stream don't know its model; that session caches the plan
+    elif use_cache and served.get("model"):
+        get_ai_cache().put(ai_cache_key("plan", served["model"], **cache_fields), json.dumps({"tasks": tasks}))
+
+def get_new_task_json(subject, topic, diff, user_context="", use_cache=True, avoid=(), context=""):
+    """Generate one replacement task.
+    
+    Up to NEW_TASK_CACHE_VARIANTS tasks are cached per subject/topic/difficulty;
+    a cached task whose text is in `avoid` (on the board or already served to
+    this session) is skipped, and once every variant is, the model is asked.
+    Pass use_cache=False to always ask the model, e.g. for a reroll.
+    Tasks drawn from material `context` are never cached.
+    """
+    use_cache = ai_cache_enabled(use_cache) and not context
+    cache_fields = dict(
+        subject=subject.strip().lower(),
+        topic=topic.strip().lower(),
+        difficulty=diff,
+        user_context=hashlib.sha256(user_context.encode()).hexdigest(),
+    )
+    free_variants = []
+    if use_cache:
+        for variant in range(NEW_TASK_CACHE_VARIANTS):
+            cached = ai_cache_get("task", dict(cache_fields, variant=variant), diff)
+            if not cached:
+                free_variants.append(variant)
+            elif json.loads(cached).get('text') not in avoid:
+                return json.loads(cached)
+    
+    served = {}
+    task = generate_task(subject, topic, diff, user_context, context, served=served)
+    if not task:
+        return {"text": "Review materials", "solution": "No solution available."}
+    if use_cache:
+        variant = free_variants[0] if free_variants else random.randrange(NEW_TASK_CACHE_VARIANTS)
+        get_ai_cache().put(ai_cache_key("task", served["model"], variant=variant, **cache_fields), json.dumps(task))
+    return task
+
+def generate_task(subject, topic, diff, user_context="", context="", served=None, errors=None):
+    """Ask the model for one new task; None if the call or its JSON fails.
+    
+    Never coalesced: every call is meant to produce a different task. Pass
+    an `errors` list when running off the script thread (see report_ai_error).
+    """
+    prompt = f"Create one new {diff} study task for {subject}: {topic}. {f'User context: {user_context}' if user_context else ''} {f'Base it on this material: {context}' if context else ''} Include a brief solution. Return ONLY JSON: {{'text': '...', 'solution': '...'}}"
+    res = get_ai_response(prompt, is_json=True, coalesce=False, kind="task", difficulty=diff, served=served, errors=errors)
+    if not res:
+        return None
+    try:
+        task = json.loads(res)
+    except json.JSONDecodeError:
+        return None
+    return task if isinstance(task, dict) and task.get('text') else None
+
+def is_valid_task(task):
+    return (
+        isinstance(task, dict)
+        and isinstance(task.get('text'), str) and task['text'].strip() != ""
+        and isinstance(task.get('solution'), str)
+        and task.get('difficulty') in TASK_DIFFICULTIES
+    )
+
+def generate_tasks(subject, topic, difficulties, user_context="", context="", errors=None):
+    """Ask the model for several tasks (one per entry in `difficulties`) in a single call.
+    
+    Returns only the tasks that validate, so the list may be shorter than asked.
+    `errors` is as for generate_task.
+    """
+    prompt = f"""
+    Create {len(difficulties)} new, distinct study tasks for {subject}: {topic}.
+    {f'User context: {user_context}' if user_context else ''}
+    {f'Base them on this material: {context}' if context else ''}
+    Difficulties, in order: {", ".join(difficulties)}.
+    Each task MUST have a brief "solution".
+    Return ONLY JSON:
+    {{ "tasks": [
+        {{"text": "Task...", "difficulty": "{difficulties[0]}", "solution": "..."}}
+    ] }}
+    """
+    res = get_ai_response(prompt, is_json=True, coalesce=False, kind="task", difficulty=hardest_difficulty(difficulties), errors=errors)
+    if not res:
+        return []
+    try:
+        data = json.loads(res)
+    except json.JSONDecodeError:
+        return []
+    tasks = data.get('tasks', []) if isinstance(data, dict) else data
+    return [task for task in tasks if is_valid_task(task)] if isinstance(tasks, list) else []
+
+@st.cache_resource
+def get_ai_executor():
+    """Process-wide worker pool for background AI calls; its size bounds their concurrency"""
+    return ThreadPoolExecutor(
+        max_workers=int(get_setting("BRAINWASH_AI_WORKERS", "4")),
+        thread_name_prefix="brainwash-ai"
+    )
+
+class TaskPrefetcher:
+    """Keeps `depth` ready replacement tasks per difficulty for one mission.
+    
+    Missing tasks are generated on the shared AI executor, up to batch_size
+    per model call; take() hands one out instantly and queues a refill.
+    For PDF missions each call gets the next context_tokens of material per
+    task from context_source (a ChunkRotation). Failures of background calls
+    are held until the next take(), which shows them on the script thread.
+    cancel() stops everything for the mission.
+    """
+    
+    def __init__(self, subject, topic, user_context, depth, batch_size=TASK_BATCH_SIZE, context_source=None, context_tokens=0):
+        self.mission = (subject, topic, user_context)
+        self.depth = depth
+        self.batch_size = batch_size
+        self.context_source = context_source
+        self.context_tokens = context_tokens
+        self.ready = {diff: deque() for diff in TASK_DIFFICULTIES}
+        self.inflight = {diff: 0 for diff in TASK_DIFFICULTIES}
+        self.futures = set()
+        self.errors = []
+        # Re-entrant: a done callback can run inline while refill() holds it
+        self.lock = threading.RLock()
+        self.cancelled = False
+    
+    def refill(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            subject, topic, user_context = self.mission
+            wanted = []
+            for diff in TASK_DIFFICULTIES:
+                wanted += [diff] * (self.depth - len(self.ready[diff]) - self.inflight[diff])
+            for start in range(0, len(wanted), self.batch_size):
+                batch = wanted[start:start + self.batch_size]
+                for diff in batch:
+                    self.inflight[diff] += 1
+                context = self.context_source.next(self.context_tokens * len(batch)) if self.context_source else ""
+                errors = []
+                future = get_ai_executor().submit(generate_tasks, subject, topic, batch, user_context, context, errors)
+                self.futures.add(future)
+                future.add_done_callback(functools.partial(self.finished, batch, errors))
+    
+    def finished(self, batch, errors, future):
+        with self.lock:
+            for diff in batch:
+                self.inflight[diff] -= 1
+            self.futures.discard(future)
+            if not self.cancelled:
+                self.errors += errors
+            if self.cancelled or future.cancelled() or future.exception():
+                return
+            for task in future.result():
+                self.ready[task['difficulty']].append(task)
+    
+    def take(self, diff):
+        """A ready task for this difficulty, or None if the pool is empty"""
+        with self.lock:
+            task = self.ready[diff].popleft() if self.ready.get(diff) else None
+            errors, self.errors = self.errors, []
+        show_ai_errors(errors)
+        self.refill()
+        return task
+    
+    def offer(self, diff, task):
+        """Add an already generated task to the pool"""
+        with self.lock:
+            if not self.cancelled:
+                self.ready.setdefault(diff, deque()).append(task)
+    
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for future in list(self.futures):
+                future.cancel()
+            for ready in self.ready.values():
+                ready.clear()
+
+# Maintenance commands: `python brainWash.py <command>` (outside `streamlit run`)
+def run_admin_command(argv):
+    parser = argparse.ArgumentParser(prog="brainWash.py", description="BrainWash maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild-rollups", help="Recompute per-user stats tables from task history")
+    export_all = commands.add_parser("export-all", help="Bulk extract every user's task history for analysis")
+    export_all.add_argument("output", help="Destination file")
+    export_all.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    export_all.add_argument("--user-id", type=int, help="Only export this user")
+    commands.add_parser("clear-ai-cache", help="Drop every cached AI response")
+    args = parser.parse_args(argv)
+    
+    if args.command == "rebuild-rollups":
+        with db_cursor(immediate=True) as cursor:
+            rebuild_rollups(cursor)
+        print("Rollups rebuilt.")
+    elif args.command == "export-all":
+        rows = export_task_history_columnar(args.output, args.format, args.user_id, page_size=BULK_EXPORT_PAGE_SIZE)
+        print(f"Exported {rows} task completions to {args.output}")
+    elif args.command == "clear-ai-cache":
+        get_ai_cache().clear()
+        print("AI response cache cleared.")
+
+if __name__ == "__main__" and len(sys.argv) > 1 and not st.runtime.exists():
+    run_admin_command(sys.argv[1:])
+    sys.exit(0)
 
 # --- 4. Logic & State ---
 if "authenticated" not in st.session_state: st.session_state.authenticated = False
@@ -594,6 +2745,13 @@ if "current_tasks" not in st.session_state: st.session_state.current_tasks = []
 if "user_details" not in st.session_state: st.session_state.user_details = {}
 if "user_name" not in st.session_state: st.session_state.user_name = None
 if "user_db_data" not in st.session_state: st.session_state.user_db_data = None
+if "user_id" not in st.session_state: st.session_state.user_id = None
+if "prefetcher" not in st.session_state: st.session_state.prefetcher = None
+if "plan_timing" not in st.session_state: st.session_state.plan_timing = None
+if "pdf_context" not in st.session_state: st.session_state.pdf_context = None  # ChunkRotation of the mission's PDF
+if "submit_all" not in st.session_state: st.session_state.submit_all = False
+if "served_tasks" not in st.session_state: st.session_state.served_tasks = set()  # texts of replacement tasks this session got
+if "answer_feedback" not in st.session_state: st.session_state.answer_feedback = {}  # task text -> last grading result
 if "answer_mode" not in st.session_state: st.session_state.answer_mode = True  # Default to answer mode
 
 BRAIN_LEVELS = [
@@ -620,10 +2778,14 @@ def get_brain_status(xp):
             next_limit = BRAIN_LEVELS[i+1][0] if i+1 < len(BRAIN_LEVELS) else xp * 1.5
     return current, next_limit
 
-def load_user_data():
-    """Load user data from database into session state"""
+def load_user_data(user=None):
+    """Load user data into session state, from a fresh User row if given or else the database"""
     if st.session_state.user_name:
-        user = get_user(st.session_state.user_name)
+        writer = get_write_behind()
+        pending = None
+        if writer and not user:
+            user, pending = writer.read(lambda: get_user(st.session_state.user_name))
+        user = user or get_user(st.session_state.user_name)
         if user:
             st.session_state.user_db_data = {
                 'id': user[0],
@@ -637,6 +2799,96 @@ def load_user_data():
                 'learning_style': user[10],
                 'weekly_commitment': user[11]
             }
+            st.session_state.user_id = user[0]
+            WriteBehindQueue.apply_pending(st.session_state.user_db_data, pending)
+
+def ensure_task_prefetch(user_context):
+    """Start (or keep) background prefetching of replacement tasks for the current mission"""
+    details = st.session_state.user_details
+    prefetcher = st.session_state.prefetcher
+    rotation = st.session_state.pdf_context
+    if prefetcher and prefetcher.mission == (details['sub'], details['top'], user_context) and prefetcher.context_source is rotation:
+        return prefetcher
+    stop_task_prefetch()
+    depth = int(get_setting("BRAINWASH_PREFETCH_DEPTH", "1"))
+    if depth > 0:
+        batch_size = int(get_setting("BRAINWASH_TASK_BATCH", str(TASK_BATCH_SIZE)))
+        st.session_state.prefetcher = TaskPrefetcher(
+            details['sub'], details['top'], user_context, depth, batch_size,
+            context_source=rotation, context_tokens=pdf_task_context_tokens()
+        )
+        st.session_state.prefetcher.refill()
+    return st.session_state.prefetcher
+
+def stop_task_prefetch():
+    if st.session_state.get("prefetcher"):
+        st.session_state.prefetcher.cancel()
+    st.session_state.prefetcher = None
+
+def pdf_task_context_tokens():
+    return int(get_setting("BRAINWASH_PDF_TASK_TOKENS", "400"))
+
+def next_task_context():
+    """Fresh material for one new task: the next chunks of the mission's PDF, or "" for topic missions"""
+    rotation = st.session_state.pdf_context
+    return rotation.next(pdf_task_context_tokens()) if rotation else ""
+
+def get_replacement_task(diff, user_context, fresh=False):
+    """Next task for a slot: a prefetched one if ready, otherwise generated now.
+    
+    fresh=True (rerolls) skips the response cache when generating.
+    """
+    prefetcher = st.session_state.prefetcher
+    task = prefetcher.take(diff) if prefetcher else None
+    if not task:
+        details = st.session_state.user_details
+        # Cached tasks are shared by everyone on the topic; never hand this session the same one twice
+        task = get_new_task_json(
+            details['sub'],
+            details['top'],
+            diff,
+            user_context=user_context,
+            use_cache=not fresh,
+            avoid=st.session_state.served_tasks | {t['text'] for t in st.session_state.current_tasks},
+            context=next_task_context()
+        )
+    st.session_state.served_tasks.add(task['text'])
+    return task
+
+def start_replacement_task(diff, user_context):
+    """Start getting the next task for a slot without waiting on it; returns a Future.
+    
+    A prefetched task resolves at once, otherwise one is generated on the AI
+    executor. The result is (task, errors); the task may be None if
+    generation fails, and errors are shown by finish_replacement_task.
+    """
+    prefetcher = st.session_state.prefetcher
+    task = prefetcher.take(diff) if prefetcher else None
+    if task:
+        future = Future()
+        future.set_result((task, []))
+        return future
+    details = st.session_state.user_details
+    args = (details['sub'], details['top'], diff, user_context, next_task_context())
+    errors = []
+    return get_ai_executor().submit(lambda: (generate_task(*args, errors=errors), errors))
+
+def finish_replacement_task(future, diff, user_context):
+    """Wait for a started replacement task, generating one here if it failed"""
+    task, errors = future.result()
+    show_ai_errors(errors)
+    return task or get_replacement_task(diff, user_context)
+
+def keep_replacement_task(future, diff):
+    """Hand an unused started task to the prefetcher so a later slot can use it"""
+    prefetcher = st.session_state.prefetcher
+    if not prefetcher:
+        future.cancel()
+        return
+    def keep(done):
+        if not done.cancelled() and not done.exception() and done.result()[0]:
+            prefetcher.offer(diff, done.result()[0])
+    future.add_done_callback(keep)
 
 # --- 5. Login Page ---
 def render_login():
@@ -821,7 +3073,7 @@ def render_daily_goal():
         return
     
     daily_goal = st.session_state.user_db_data['daily_goal']
-    today_count = get_today_progress(st.session_state.user_name)
+    today_count = get_today_progress_by_id(st.session_state.user_id)
     progress_pct = min(today_count / daily_goal, 1.0)
     
     st.markdown(f"""
@@ -847,7 +3099,7 @@ def render_insights():
         st.warning("No data available yet. Complete some tasks to see your insights!")
         return
     
-    analytics = get_user_analytics(st.session_state.user_name)
+    analytics = get_user_analytics_by_id(st.session_state.user_id)
     
     if not analytics:
         st.warning("No analytics data available yet.")
@@ -855,24 +3107,46 @@ def render_insights():
     
     # Export Button
     col1, col2, col3 = st.columns([2, 1, 1])
+    with col1:
+        delta_only = st.toggle(
+            "🔁 Only tasks new since my last export",
+            help="Turn off to re-export your full history (a full resync)"
+        )
+    with col2:
+        if pa is not None and st.button("🧱 Export to Parquet", use_container_width=True):
+            after_id, until_id = begin_delta_export(st.session_state.user_id, full_resync=not delta_only)
+            if until_id > after_id:
+                with spool_export(lambda out: export_task_history_columnar(out, "parquet", st.session_state.user_id, after_id=after_id, until_id=until_id)) as export:
+                    st.download_button(
+                        label="⬇️ Download Parquet",
+                        data=export,
+                        file_name=f"brainwash_data_{st.session_state.user_name}_{date.today()}.parquet",
+                        mime="application/vnd.apache.parquet",
+                        use_container_width=True,
+                        # Only a download moves the watermark; an export nobody saved must stay in the next delta
+                        on_click=commit_delta_export,
+                        args=(st.session_state.user_id, until_id)
+                    )
+            else:
+                st.info("No new data to export!" if delta_only else "No data to export yet!")
     with col3:
         if st.button("📤 Export to CSV", use_container_width=True):
-            if analytics['all_tasks']:
-                df = pd.DataFrame(
-                    analytics['all_tasks'],
-                    columns=['Completed At', 'Subject', 'Topic', 'Task', 'Difficulty', 'XP Earned']
-                )
-                csv = df.to_csv(index=False)
-                st.download_button(
-                    label="⬇️ Download CSV",
-                    data=csv,
-                    file_name=f"brainwash_data_{st.session_state.user_name}_{date.today()}.csv",
-                    mime="text/csv",
-                    use_container_width=True
-                )
+            after_id, until_id = begin_delta_export(st.session_state.user_id, full_resync=not delta_only)
+            if until_id > after_id:
+                # Built only on demand, streamed page by page through a temp file
+                with spool_export(lambda out: out.writelines(iter_task_history_csv(st.session_state.user_id, after_id, until_id))) as export:
+                    st.download_button(
+                        label="⬇️ Download CSV",
+                        data=export,
+                        file_name=f"brainwash_data_{st.session_state.user_name}_{date.today()}.csv",
+                        mime="text/csv",
+                        use_container_width=True,
+                        on_click=commit_delta_export,
+                        args=(st.session_state.user_id, until_id)
+                    )
                 st.success("✅ CSV ready for download!")
             else:
-                st.info("No data to export yet!")
+                st.info("No new data to export!" if delta_only else "No data to export yet!")
     
     st.divider()
     
@@ -980,6 +3254,40 @@ def render_insights():
             """, unsafe_allow_html=True)
     else:
         st.info("No recent tasks to display.")
+    
+    # AI service health (shared by every session on this server)
+    with st.expander("🩺 AI Service Health"):
+        ai_stats = get_ai_guard().stats()
+        h1, h2, h3, h4 = st.columns(4)
+        h1.metric("Model Calls", ai_stats['calls'])
+        h2.metric("Retries", ai_stats['retries'])
+        h3.metric("Refused (Busy)", ai_stats['throttled'] + ai_stats['breaker_rejections'])
+        h4.metric("Avg Latency", f"{ai_stats['avg_latency']:.1f}s")
+        routing = get_model_router().stats()
+        if routing:
+            st.dataframe(pd.DataFrame([
+                {
+                    "Model": model,
+                    "Calls (5 min)": stats['calls'],
+                    "p50 (s)": stats['p50'],
+                    "p95 (s)": stats['p95'],
+                    "Error Rate": f"{stats['error_rate']:.0%}",
+                    "Circuit": ai_stats['breakers'].get(model, "closed"),
+                    "Preferred": "✅" if stats['healthy'] else "⚠️ fallback",
+                }
+                for model, stats in routing.items()
+            ]), hide_index=True, use_container_width=True)
+        shared = get_single_flight().stats()['shared_calls']
+        st.caption(f"🤝 {shared} requests were served by an identical request already in flight")
+        grading = get_grading_stats().stats()
+        st.caption(
+            f"✍️ {grading['local']} of {grading['local'] + grading['model']} answers graded locally "
+            f"({grading['avoided_share']:.0%} of grading calls avoided)"
+        )
+        pdf_cache = get_pdf_cache().stats()
+        st.caption(f"📄 PDF cache: {pdf_cache['hits']} hits, {pdf_cache['misses']} misses ({pdf_cache['hit_rate']:.0%} of uploads and indexes reused)")
+        blobs = get_blob_store().stats()
+        st.caption(f"🗂️ PDF texts: {blobs['referenced']} in use by sessions, {blobs['mapped']} memory-mapped, {blobs['blobs_collected']} unused ones deleted")
 
 # --- 9. Profile ---
 def render_profile():
@@ -1111,6 +3419,124 @@ def render_profile():
             """, unsafe_allow_html=True)
 
 # --- 10. Arcade ---
+def render_task_card(task):
+    d = task['difficulty']
+    st.markdown(f"""
+        <div class="task-card diff-{d}">
+            <span class="badge bg-{d}">{d} | +{task['xp']} XP</span>
+            <div style="margin-top:10px;">{html.escape(task['text'])}</div>
+        </div>
+    """, unsafe_allow_html=True)
+
+def start_mission(subject, topic, user_context, context="", rotation=None):
+    """Generate the mission plan, showing each task as soon as it streams in.
+    
+    Records time to first task and to the full plan; returns False if no
+    tasks came back. BRAINWASH_STREAM_PLAN=off waits for the whole plan instead.
+    `rotation` (PDF missions) supplies material for later tasks.
+    """
+    started = time.perf_counter()
+    first_task = None
+    if get_flag("BRAINWASH_STREAM_PLAN", True):
+        tasks = []
+        for task in stream_initial_plan(subject, topic, context, user_context=user_context):
+            if first_task is None:
+                first_task = time.perf_counter() - started
+            tasks.append(task)
+            render_task_card(task)
+    else:
+        plan = get_initial_plan(subject, topic, context, user_context=user_context)
+        tasks = plan['tasks'] if plan else []
+    if not tasks:
+        return False
+    total = time.perf_counter() - started
+    st.session_state.current_tasks = tasks
+    st.session_state.user_details = {"sub": subject, "top": topic}
+    st.session_state.pdf_context = rotation
+    st.session_state.plan_timing = {"first_task": first_task if first_task is not None else total, "total": total}
+    return True
+
+def render_feedback(result):
+    status_emoji = {"correct": "🎉", "partial": "👍", "incorrect": "❌"}
+    st.markdown(f"""
+        <div class="answer-feedback feedback-{result['status']}">
+            <strong>{status_emoji.get(result['status'], '💭')} {result['feedback']}</strong><br>
+            <small>Score: {result['score']}/100</small>
+        </div>
+    """, unsafe_allow_html=True)
+
+def render_submit_all(user_data, user_context):
+    """Answer mode with a single form: every answer is graded in one call and saved in one transaction"""
+    tasks = st.session_state.current_tasks
+    feedback = {text: result for text, result in st.session_state.answer_feedback.items() if text in {t['text'] for t in tasks}}
+    st.session_state.answer_feedback = feedback
+    
+    rerolls = []
+    with st.form("answer_all_form"):
+        for i, task in enumerate(tasks):
+            render_task_card(task)
+            st.text_area("✍️ Your Answer:", placeholder="Write your answer here...", height=100, key=f"answer_{i}")
+            if task['text'] in feedback:
+                render_feedback(feedback[task['text']])
+            with st.expander("💡 Show Solution"):
+                st.write(task.get('solution', 'No solution found.'))
+            if st.form_submit_button("🎲 Reroll (-20)", key=f"r{i}"):
+                rerolls.append(i)
+        submit_all = st.form_submit_button("✅ Submit All Answers", type="primary", use_container_width=True)
+    
+    for i in rerolls:
+        if user_data['total_xp'] < 20:
+            st.error("Not enough XP to reroll!")
+            return
+        d, xp = tasks[i]['difficulty'], tasks[i]['xp']
+        load_user_data(update_user_stats_by_id(st.session_state.user_id, xp_gained=-20))
+        with st.spinner("Rerolling..."):
+            new = get_replacement_task(d, user_context, fresh=True)
+            tasks[i] = {**new, "difficulty": d, "xp": xp}
+        st.rerun()
+    
+    if not submit_all:
+        return
+    answered = [(i, task, st.session_state[f"answer_{i}"].strip()) for i, task in enumerate(tasks) if st.session_state[f"answer_{i}"].strip()]
+    if not answered:
+        st.warning("Write at least one answer first.")
+        return
+    
+    with st.spinner(f"🤖 AI is checking {len(answered)} answers..."):
+        # Replacements are generated while grading; unused ones go back to the prefetcher
+        replacements = {i: start_replacement_task(task['difficulty'], user_context) for i, task, _ in answered}
+        results = check_answers(
+            [(task['text'], task.get('solution', ''), answer) for _, task, answer in answered],
+            difficulty=hardest_difficulty([task['difficulty'] for _, task, _ in answered])
+        )
+        passed = []
+        for (i, task, answer), result in zip(answered, results):
+            if result:
+                feedback[task['text']] = result
+            if result and result['score'] >= 60:  # Partial credit threshold
+                passed.append((i, task, answer, result, int(task['xp'] * (result['score'] / 100))))
+            else:
+                keep_replacement_task(replacements[i], task['difficulty'])
+        
+        if passed:
+            details = st.session_state.user_details
+            load_user_data(complete_tasks_by_id(
+                st.session_state.user_id,
+                [(task['text'], task['difficulty'], earned_xp, answer, result['feedback']) for _, task, answer, result, earned_xp in passed],
+                details['sub'],
+                details['top']
+            ))
+            for i, task, _, _, _ in passed:
+                new = finish_replacement_task(replacements[i], task['difficulty'], user_context)
+                tasks[i] = {**new, "difficulty": task['difficulty'], "xp": task['xp']}
+                del st.session_state[f"answer_{i}"]
+            st.toast(f"🎊 {len(passed)} of {len(answered)} answers passed: earned {sum(p[4] for p in passed)} XP!")
+        elif any(results):
+            st.toast("💪 Keep trying! Check the feedback under each answer.")
+        if None in results:
+            st.toast(f"⚠️ {results.count(None)} answers couldn't be graded, please submit them again.")
+    st.rerun()
+
 def render_arcade():
     if not st.session_state.user_db_data:
         st.error("User data not loaded!")
@@ -1148,6 +3574,12 @@ def render_arcade():
             help="When enabled, you can write your answers and get AI feedback"
         )
         st.session_state.answer_mode = answer_mode
+        st.session_state.submit_all = st.toggle(
+            "📚 Submit All at Once",
+            value=st.session_state.submit_all,
+            disabled=not answer_mode,
+            help="Answer several tasks, then grade them together in one AI call"
+        )
 
     if not st.session_state.user_details:
         # User context for AI
@@ -1163,168 +3595,162 @@ def render_arcade():
                 sub = st.text_input("Subject", default_subject)
                 top = st.text_input("Topic", "")
                 if st.form_submit_button("Start Mission"):
-                    plan = get_initial_plan(sub, top, user_context=user_context)
-                    if plan:
-                        st.session_state.current_tasks = plan['tasks']
-                        st.session_state.user_details = {"sub": sub, "top": top}
+                    if start_mission(sub, top, user_context):
                         st.rerun()
         with t2:
             with st.form("pdf"):
                 sub_p = st.text_input("Subject", default_subject)
+                focus = st.text_input("Focus (optional)", "", help="What to study in this PDF; the most relevant pages are used")
+                page_range = st.text_input("Pages (optional)", "", placeholder="e.g. 1-20, 35, 40-", help="Only read these pages")
                 f = st.file_uploader("Upload PDF", type="pdf")
                 if st.form_submit_button("Analyze & Play"):
                     if f:
-                        reader = pypdf.PdfReader(f)
-                        txt = "".join([p.extract_text() for p in reader.pages])
-                        plan = get_initial_plan(sub_p, f.name, txt, user_context=user_context)
-                        if plan:
-                            st.session_state.current_tasks = plan['tasks']
-                            st.session_state.user_details = {"sub": sub_p, "top": f.name, "pdf_text": txt}
-                            st.rerun()
+                        try:
+                            with st.spinner("Reading PDF..."):
+                                blob, report = read_pdf(
+                                    f,
+                                    page_range,
+                                    max_chars=int(get_setting("BRAINWASH_PDF_MAX_CHARS", "300000")),
+                                    time_budget=float(get_setting("BRAINWASH_PDF_TIME_BUDGET", "15")),
+                                )
+                        except ValueError as e:
+                            st.error(str(e))
+                        else:
+                            # Send only the chunks most relevant to the subject and focus
+                            rotation = ChunkRotation(blob, f"{sub_p} {focus or Path(f.name).stem}")
+                            context = rotation.next(int(get_setting("BRAINWASH_PDF_CONTEXT_TOKENS", "1250")))
+                            if start_mission(sub_p, focus or f.name, user_context, context, rotation=rotation):
+                                st.session_state.plan_timing['pdf'] = report
+                                st.rerun()
     else:
         st.caption(f"Mission: {st.session_state.user_details['top']}")
+        if st.session_state.plan_timing:
+            timing = st.session_state.plan_timing
+            st.caption(f"⚡ First task in {timing['first_task']:.1f}s · full plan in {timing['total']:.1f}s")
+            if timing.get('pdf'):
+                report = timing['pdf']
+                slowest = max(report['page_timings'], key=lambda page: page[2], default=None)
+                if report.get('cached'):
+                    st.caption(f"📄 Reused the text of {report['pages_read']} of {report['pages_selected']} pages from the PDF cache")
+                else:
+                    st.caption(
+                        f"📄 Read {report['pages_read']} of {report['pages_selected']} pages in {report['seconds']:.1f}s"
+                        + (f" · slowest page {slowest[0]} ({slowest[2]:.2f}s)" if slowest else "")
+                        + (f" · stopped early: {report['error']}" if report.get('error') else " · stopped at the reading budget" if report['truncated'] else "")
+                    )
         user_context = f"Subjects: {user_data['subjects_interested']}, Learning style: {user_data['learning_style']}"
+        ensure_task_prefetch(user_context)
         
-        for i, task in enumerate(st.session_state.current_tasks):
-            d = task['difficulty']
-            xp = task['xp']
-            st.markdown(f"""
-                <div class="task-card diff-{d}">
-                    <span class="badge bg-{d}">{d} | +{xp} XP</span>
-                    <div style="margin-top:10px;">{html.escape(task['text'])}</div>
-                </div>
-            """, unsafe_allow_html=True)
-            
-            # Answer Mode
-            if st.session_state.answer_mode:
-                with st.form(f"answer_form_{i}"):
-                    user_answer = st.text_area(
-                        "✍️ Your Answer:",
-                        placeholder="Write your answer here...",
-                        height=100,
-                        key=f"answer_{i}"
-                    )
-                    
-                    col1, col2, col3 = st.columns(3)
-                    submit_answer = col1.form_submit_button("✅ Submit Answer", type="primary", use_container_width=True)
-                    
-                    if submit_answer and user_answer.strip():
-                        with st.spinner("🤖 AI is checking your answer..."):
-                            result = check_answer(task['text'], task.get('solution', ''), user_answer)
-                            
-                            if result:
-                                feedback_class = f"feedback-{result['status']}"
-                                status_emoji = {"correct": "🎉", "partial": "👍", "incorrect": "❌"}
-                                
-                                st.markdown(f"""
-                                    <div class="answer-feedback {feedback_class}">
-                                        <strong>{status_emoji.get(result['status'], '💭')} {result['feedback']}</strong><br>
-                                        <small>Score: {result['score']}/100</small>
-                                    </div>
-                                """, unsafe_allow_html=True)
-                                
-                                # Award XP based on score
-                                earned_xp = int(xp * (result['score'] / 100))
+        if st.session_state.answer_mode and st.session_state.submit_all:
+            render_submit_all(user_data, user_context)
+        else:
+            for i, task in enumerate(st.session_state.current_tasks):
+                d = task['difficulty']
+                xp = task['xp']
+                render_task_card(task)
+                
+                # Answer Mode
+                if st.session_state.answer_mode:
+                    with st.form(f"answer_form_{i}"):
+                        user_answer = st.text_area(
+                            "✍️ Your Answer:",
+                            placeholder="Write your answer here...",
+                            height=100,
+                            key=f"answer_{i}"
+                        )
+                        
+                        col1, col2, col3 = st.columns(3)
+                        submit_answer = col1.form_submit_button("✅ Submit Answer", type="primary", use_container_width=True)
+                        
+                        if submit_answer and user_answer.strip():
+                            with st.spinner("🤖 AI is checking your answer..."):
+                                # Generate the replacement while grading; kept for later if the answer fails
+                                replacement = start_replacement_task(d, user_context)
+                                result = check_answer(task['text'], task.get('solution', ''), user_answer, d)
                                 
-                                if result['score'] >= 60:  # Partial credit threshold
-                                    update_user_stats(st.session_state.user_name, xp_gained=earned_xp, task_completed=True)
-                                    log_task_completion(
-                                        st.session_state.user_name,
-                                        task['text'],
-                                        d,
-                                        earned_xp,
-                                        st.session_state.user_details['sub'],
-                                        st.session_state.user_details['top'],
-                                        user_answer,
-                                        result['feedback']
-                                    )
-                                    load_user_data()
+                                if result:
+                                    render_feedback(result)
                                     
-                                    st.success(f"🎊 Earned {earned_xp} XP!")
+                                    # Award XP based on score
+                                    earned_xp = int(xp * (result['score'] / 100))
                                     
-                                    # Generate new task
-                                    with st.spinner("Generating new task..."):
-                                        new = get_new_task_json(
-                                            st.session_state.user_details['sub'], 
-                                            st.session_state.user_details['top'], 
+                                    if result['score'] >= 60:  # Partial credit threshold
+                                        load_user_data(complete_task_by_id(
+                                            st.session_state.user_id,
+                                            task['text'],
                                             d,
-                                            user_context=user_context
-                                        )
-                                        st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
-                                    
-                                    time.sleep(1)
-                                    st.rerun()
+                                            earned_xp,
+                                            st.session_state.user_details['sub'],
+                                            st.session_state.user_details['top'],
+                                            user_answer,
+                                            result['feedback']
+                                        ))
+                                        
+                                        st.toast(f"🎊 Earned {earned_xp} XP!")
+                                        
+                                        # Swap in the replacement started alongside grading
+                                        with st.spinner("Generating new task..."):
+                                            new = finish_replacement_task(replacement, d, user_context)
+                                            st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
+                                        
+                                        st.rerun()
+                                    else:
+                                        keep_replacement_task(replacement, d)
+                                        st.info("💪 Keep trying! You can reroll or try a different approach.")
                                 else:
-                                    st.info("💪 Keep trying! You can reroll or try a different approach.")
-            
-            else:
-                # Regular mode (quick complete)
-                c1, c2 = st.columns(2)
-                with c1:
-                    if st.button("✅ Done", key=f"d{i}", use_container_width=True, type="primary"):
-                        # Update database
-                        update_user_stats(st.session_state.user_name, xp_gained=xp, task_completed=True)
-                        log_task_completion(
-                            st.session_state.user_name,
-                            task['text'],
-                            d,
-                            xp,
-                            st.session_state.user_details['sub'],
-                            st.session_state.user_details['top']
-                        )
-                        load_user_data()
-                        
-                        # Generate new task
-                        with st.spinner("New task..."):
-                            new = get_new_task_json(
-                                st.session_state.user_details['sub'], 
-                                st.session_state.user_details['top'], 
+                                    keep_replacement_task(replacement, d)
+                
+                else:
+                    # Regular mode (quick complete)
+                    c1, c2 = st.columns(2)
+                    with c1:
+                        if st.button("✅ Done", key=f"d{i}", use_container_width=True, type="primary"):
+                            # Update database
+                            load_user_data(complete_task_by_id(
+                                st.session_state.user_id,
+                                task['text'],
                                 d,
-                                user_context=user_context
-                            )
-                            st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
-                        st.rerun()
+                                xp,
+                                st.session_state.user_details['sub'],
+                                st.session_state.user_details['top']
+                            ))
+                            
+                            # Generate new task
+                            with st.spinner("New task..."):
+                                new = get_replacement_task(d, user_context)
+                                st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
+                            st.rerun()
+                    
+                    with c2:
+                        if st.button("🎲 Reroll (-20)", key=f"r{i}", use_container_width=True):
+                            if user_data['total_xp'] >= 20:
+                                load_user_data(update_user_stats_by_id(st.session_state.user_id, xp_gained=-20))
+                                with st.spinner("Rerolling..."):
+                                    new = get_replacement_task(d, user_context, fresh=True)
+                                    st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
+                                st.rerun()
+                            else:
+                                st.error("Not enough XP to reroll!")
                 
-                with c2:
+                # Reroll button for Answer Mode
+                if st.session_state.answer_mode:
                     if st.button("🎲 Reroll (-20)", key=f"r{i}", use_container_width=True):
                         if user_data['total_xp'] >= 20:
-                            update_user_stats(st.session_state.user_name, xp_gained=-20)
-                            load_user_data()
+                            load_user_data(update_user_stats_by_id(st.session_state.user_id, xp_gained=-20))
                             with st.spinner("Rerolling..."):
-                                new = get_new_task_json(
-                                    st.session_state.user_details['sub'], 
-                                    st.session_state.user_details['top'], 
-                                    d,
-                                    user_context=user_context
-                                )
+                                new = get_replacement_task(d, user_context, fresh=True)
                                 st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
                             st.rerun()
                         else:
                             st.error("Not enough XP to reroll!")
-            
-            # Reroll button for Answer Mode
-            if st.session_state.answer_mode:
-                if st.button("🎲 Reroll (-20)", key=f"r{i}", use_container_width=True):
-                    if user_data['total_xp'] >= 20:
-                        update_user_stats(st.session_state.user_name, xp_gained=-20)
-                        load_user_data()
-                        with st.spinner("Rerolling..."):
-                            new = get_new_task_json(
-                                st.session_state.user_details['sub'], 
-                                st.session_state.user_details['top'], 
-                                d,
-                                user_context=user_context
-                            )
-                            st.session_state.current_tasks[i] = {**new, "difficulty": d, "xp": xp}
-                        st.rerun()
-                    else:
-                        st.error("Not enough XP to reroll!")
-            
-            with st.expander("💡 Show Solution"):
-                st.write(task.get('solution', 'No solution found.'))
+                
+                with st.expander("💡 Show Solution"):
+                    st.write(task.get('solution', 'No solution found.'))
         
         if st.button("🏳️ Reset Session"):
+            stop_task_prefetch()
             st.session_state.user_details = {}
+            st.session_state.pdf_context = None
             st.rerun()
 
 # --- 11. Main App Logic ---
@@ -1362,6 +3788,7 @@ else:
         
         st.divider()
         if st.button("🚪 Logout", use_container_width=True):
+            stop_task_prefetch()
             st.session_state.clear()
             st.rerun()
     
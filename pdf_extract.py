@@ -0,0 +1,258 @@
+"""PDF text extraction in worker processes.
+
+pypdf is pure Python and CPU-bound, so BrainWash never parses an upload on
+the Streamlit script thread. Pages are split into jobs run by a shared process
+pool; every worker has a memory cap and every job a timeout, and workers whose
+job overruns are killed instead of being left to stall the server. Jobs get the
+path of a temp copy of the upload rather than its bytes. This module has no
+Streamlit dependency so worker processes can import it cheaply.
+"""
+import multiprocessing
+import os
+import re
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import pypdf
+
+try:
+    import resource
+except ImportError:  # No RLIMIT_AS outside Unix; workers run without a memory cap
+    resource = None
+
+if "forkserver" in multiprocessing.get_all_start_methods():
+    # Forking the multi-threaded server is unsafe; a fork server with pypdf preloaded is not
+    WORKER_CONTEXT = multiprocessing.get_context("forkserver")
+    WORKER_CONTEXT.set_forkserver_preload([__name__])
+else:
+    WORKER_CONTEXT = multiprocessing.get_context("spawn")
+
+def parse_page_range(spec, page_count):
+    """0-based page numbers for a spec like "1-5, 8, 12-" (1-based, inclusive); all pages if blank"""
+    if not spec.strip():
+        return list(range(page_count))
+    pages = []
+    for part in spec.split(","):
+        match = re.fullmatch(r"\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?", part)
+        if not match:
+            raise ValueError(f"Invalid page range: {part.strip()!r}")
+        first = int(match.group(1))
+        last = (int(match.group(3)) if match.group(3) else page_count) if match.group(2) else first
+        if not 1 <= first <= last:
+            raise ValueError(f"Invalid page range: {part.strip()!r}")
+        pages.extend(range(first - 1, min(last, page_count)))
+    return list(dict.fromkeys(pages))
+
+def iter_pdf_pages(reader, pages):
+    """Yield (page_number, text, seconds) for each selected page, extracting only when asked"""
+    for number in pages:
+        started = time.perf_counter()
+        text = reader.pages[number].extract_text() or ""
+        yield number, text, time.perf_counter() - started
+
+# Worker side
+def start_worker(max_bytes, started):
+    """Worker initializer: report our PID so the pool can kill us, then cap the
+    address space so a PDF bomb fails with MemoryError instead of swapping"""
+    started.put(os.getpid())
+    if resource and max_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+def count_pages(path):
+    return len(pypdf.PdfReader(path).pages)
+
+def extract_pages(path, pages, max_chars, deadline):
+    """Job: [(page, text, chars, seconds)] for pages in order, stopping at max_chars or the wall-clock deadline"""
+    reader = pypdf.PdfReader(path)
+    results, size = [], 0
+    for number, text, seconds in iter_pdf_pages(reader, pages):
+        results.append((number, text[:max_chars - size], len(text), seconds))
+        size += len(results[-1][1])
+        if size >= max_chars or time.time() >= deadline:
+            break
+    return results
+
+# Server side
+def stop_workers(executor, started):
+    """Kill an executor's processes outright; a stuck pypdf call never returns on its own.
+    
+    `started` is the queue its workers reported their PIDs to from start_worker.
+    """
+    executor.shutdown(wait=False, cancel_futures=True)
+    while not started.empty():
+        try:
+            os.kill(started.get(), signal.SIGTERM)
+        except ProcessLookupError:  # Already gone
+            pass
+
+class PdfWorkerPool:
+    """Worker processes shared by every PDF read on the server.
+    
+    Workers start once (pypdf imported, memory capped) and are reused; the pool
+    size bounds how much CPU PDF parsing can take. restart() kills every worker,
+    for a job stuck past its timeout or a crashed pool, and starts fresh ones;
+    the workers of each executor report their PIDs to self.started for that.
+    """
+    
+    def __init__(self, workers=2, memory_limit=1024 * 1024 * 1024):
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.executor = self.start()
+    
+    def start(self):
+        self.started = WORKER_CONTEXT.SimpleQueue()
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=WORKER_CONTEXT,
+            initializer=start_worker, initargs=(self.memory_limit, self.started)
+        )
+    
+    def submit(self, fn, *args):
+        """(future, generation) for fn(*args) run in a worker"""
+        with self.lock:
+            try:
+                return self.executor.submit(fn, *args), self.generation
+            except BrokenProcessPool:  # A worker died (e.g. killed by the OS); replace them all
+                self.replace()
+                return self.executor.submit(fn, *args), self.generation
+    
+    def restart(self, generation):
+        """Replace the workers, unless that already happened since `generation`"""
+        with self.lock:
+            if generation == self.generation:
+                self.replace()
+    
+    def replace(self):
+        # Caller holds self.lock
+        stop_workers(self.executor, self.started)
+        self.executor = self.start()
+        self.generation += 1
+    
+    def shutdown(self):
+        with self.lock:
+            stop_workers(self.executor, self.started)
+
+def describe_failure(error):
+    if isinstance(error, MemoryError):
+        return "This PDF needs more memory to read than the server allows"
+    if isinstance(error, BrokenProcessPool):
+        return "The PDF reader crashed on this file (it may need more memory than the server allows)"
+    if isinstance(error, FutureTimeoutError):
+        return "Reading this PDF took too long"
+    return f"Couldn't read this PDF: {error}"
+
+def run_job(pool, job_timeout, fn, *args):
+    """fn(*args) in the pool, waiting at most job_timeout; a job that overruns gets the workers killed"""
+    for attempt in range(2):
+        future, generation = pool.submit(fn, *args)
+        try:
+            return future.result(timeout=job_timeout)
+        except FutureTimeoutError:
+            pool.restart(generation)
+            raise
+        except BrokenProcessPool:
+            # Maybe another read's timeout killed the workers; one retry tells that apart from our own crash
+            pool.restart(generation)
+            if attempt:
+                raise
+
+def extract_pdf_text(upload, pool, page_range="", max_chars=300_000, time_budget=15.0,
+                     parallel=2, pages_per_job=20, job_timeout=30.0):
+    """Extract a PDF's text in worker processes until the character or time budget runs out.
+    
+    upload is the PDF as a binary file object; it is copied to a temp file
+    once and jobs only get that file's path. Selected pages are read in jobs
+    of pages_per_job, at most `parallel` at a time and collected in order, so
+    reading stops early once max_chars is reached. Pages read before a job timed out or
+    failed are kept; a PDF that can't be opened at all raises ValueError.
+    
+    Returns (text, report); the report has the pages read and selected, the
+    per-page (page, chars, seconds) timings, each page's (page, offset) in the
+    text, whether the budget cut it short (timed_out if it was the clock) and
+    the error that stopped reading early, if any.
+    """
+    started = time.perf_counter()
+    deadline = time.time() + time_budget
+    copy = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+    try:
+        with copy:
+            shutil.copyfileobj(upload, copy)
+        return read_pages(copy.name, pool, page_range, max_chars, deadline, parallel, pages_per_job, job_timeout, started)
+    finally:
+        try:
+            os.unlink(copy.name)
+        except OSError:  # Windows: a worker still has it open
+            pass
+
+def read_pages(path, pool, page_range, max_chars, deadline, parallel, pages_per_job, job_timeout, started):
+    # extract_pdf_text for the PDF at path
+    try:
+        page_count = run_job(pool, job_timeout, count_pages, path)
+    except Exception as e:
+        raise ValueError(describe_failure(e)) from e
+    pages = parse_page_range(page_range, page_count)
+    if not pages:
+        raise ValueError(f"The page range selects none of this PDF's {page_count} pages")
+    
+    jobs = deque(pages[start:start + pages_per_job] for start in range(0, len(pages), pages_per_job))
+    running = deque()
+    parts, timings, offsets, size = [], [], [], 0
+    error = None
+    try:
+        while True:
+            while jobs and len(running) < parallel and size < max_chars and time.time() < deadline:
+                job = jobs.popleft()
+                # Jobs run concurrently; each waits up to job_timeout from when it is collected
+                running.append((job, *pool.submit(extract_pages, path, job, max_chars, deadline)))
+            if not running or size >= max_chars:
+                break
+            job, future, generation = running.popleft()
+            try:
+                results = future.result(timeout=job_timeout)
+            except BrokenProcessPool:
+                try:
+                    results = run_job(pool, job_timeout, extract_pages, path, job, max_chars, deadline)
+                except Exception as e:
+                    error = e
+            except FutureTimeoutError as e:
+                pool.restart(generation)
+                error = e
+            except Exception as e:
+                error = e
+            if error:
+                if not timings:
+                    raise ValueError(describe_failure(error)) from error
+                break
+            for number, text, chars, seconds in results:
+                if size >= max_chars:
+                    break
+                offsets.append((number + 1, size))
+                parts.append(text[:max_chars - size])
+                size += len(parts[-1])
+                timings.append((number + 1, chars, seconds))
+    finally:
+        # Stopped early (budget, error or the caller going away): drop jobs not started yet;
+        # started ones end by themselves at the deadline
+        for _, future, _ in running:
+            future.cancel()
+    
+    truncated = len(timings) < len(pages)
+    report = {
+        "pages_read": len(timings),
+        "pages_selected": len(pages),
+        "page_timings": timings,
+        "page_offsets": offsets,
+        "seconds": time.perf_counter() - started,
+        "truncated": truncated,
+        # Out of time (time_budget or a job's timeout) rather than characters or a failing page
+        "timed_out": truncated and size < max_chars and (error is None or isinstance(error, FutureTimeoutError)),
+        "error": describe_failure(error) if error else None,
+    }
+    return "".join(parts), report
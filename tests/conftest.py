@@ -0,0 +1,18 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+@pytest.fixture(scope="session")
+def brainwash(tmp_path_factory):
+    """The app module, imported in Streamlit's bare mode with its database in a temp dir"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        import brainWash
+    finally:
+        os.chdir(cwd)
+    return brainWash
@@ -0,0 +1,110 @@
+import time
+
+import pytest
+from google.genai import errors as genai_errors
+
+class FakeRoutingClient:
+    """Offline stand-in for genai.Client with a scripted failure rate per model; logs the models called"""
+    
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+        self.models = self
+    
+    def generate_content(self, model, contents, config=None):
+        self.calls.append(model)
+        if model in self.failing:
+            raise genai_errors.ServerError(503, {"error": {"code": 503, "message": f"{model} is overloaded", "status": "UNAVAILABLE"}})
+        return model
+
+@pytest.fixture
+def make_router(brainwash):
+    def make(routes=None, **kwargs):
+        return brainwash.ModelRouter(routes or {"default": ["a", "b", "c"]}, **{"slow_p95": 1.0, "max_error_rate": 0.5, **kwargs})
+    return make
+
+@pytest.fixture
+def make_guard(brainwash):
+    def make(breaker_failures=5):
+        return brainwash.AIGuard(rpm=60000, burst=1000, retries=2, deadline=10, attempt_timeout=10,
+                                 breaker_failures=breaker_failures, breaker_cooldown=60, base_backoff=0, max_backoff=0)
+    return make
+
+def ask(router, client, guard, kind="default", difficulty=None):
+    return router.call(kind, difficulty, lambda model, timeout: client.generate_content(model, "ping"), guard)
+
+def test_falls_back_in_route_order(make_router, make_guard):
+    router, client = make_router(), FakeRoutingClient(failing={"a", "b"})
+    
+    assert ask(router, client, make_guard()) == "c"
+    assert client.calls == ["a", "b", "c"]
+    assert router.counters["fallbacks"] == 2
+
+def test_last_model_is_retried_and_its_error_raised(make_router, make_guard):
+    router, client = make_router({"default": ["a", "b"]}), FakeRoutingClient(failing={"a", "b"})
+    
+    with pytest.raises(genai_errors.ServerError):
+        ask(router, client, make_guard())
+    assert client.calls == ["a", "b", "b", "b"]
+
+def test_routes_by_kind_and_difficulty(make_router):
+    router = make_router({"default": ["a"], "task": ["b"], "task:Easy": ["c"]})
+    
+    assert router.route("task", "Easy") == ["c"]
+    assert router.route("task", "Hard") == ["b"]
+    assert router.route("grade", "Easy") == ["a"]
+
+def test_open_breaker_skips_model(make_router, make_guard):
+    router, guard = make_router(), make_guard(breaker_failures=1)
+    client = FakeRoutingClient(failing={"a"})
+    ask(router, client, guard)
+    
+    client.failing.clear()
+    client.calls.clear()
+    assert ask(router, client, guard) == "b"
+    assert client.calls == ["b"]
+    assert guard.stats()["breakers"]["a"] == "open"
+
+def test_latency_percentiles_and_error_rate(make_router):
+    router = make_router()
+    for latency in range(1, 101):
+        router.record("a", latency / 100, ok=True)
+    router.record("a", None, ok=True)  # Streams count as calls but not towards latency
+    for _ in range(9):
+        router.record("a", None, ok=False)
+    
+    stats = router.model_stats("a")
+    assert stats["calls"] == 110
+    assert stats["p50"] == pytest.approx(0.51)
+    assert stats["p95"] == pytest.approx(0.96)
+    assert stats["error_rate"] == pytest.approx(9 / 110)
+    assert router.model_stats("b") == {"calls": 0, "error_rate": 0.0, "p50": None, "p95": None}
+
+def test_slow_or_failing_model_moves_to_the_back(make_router):
+    router = make_router(slow_p95=0.5, min_samples=5)
+    for _ in range(5):
+        router.record("a", 0.9, ok=True)
+        router.record("b", None, ok=False)
+    
+    assert not router.healthy("a")
+    assert not router.healthy("b")
+    assert router.route("default") == ["c", "a", "b"]
+
+def test_latency_excludes_rate_limit_wait(brainwash, make_router):
+    router, client = make_router({"default": ["a"]}), FakeRoutingClient()
+    guard = brainwash.AIGuard(rpm=600, burst=1, retries=0, deadline=10, attempt_timeout=10,
+                              breaker_failures=5, breaker_cooldown=60)
+    for _ in range(3):  # Past the burst, each call waits ~0.1s for a token
+        ask(router, client, guard)
+    
+    assert router.model_stats("a")["p95"] < 0.05
+
+def test_samples_expire_after_horizon(make_router):
+    router = make_router(horizon=0.05)
+    for _ in range(5):
+        router.record("a", None, ok=False)
+    assert router.route("default")[0] == "b"
+    
+    time.sleep(0.1)
+    assert router.model_stats("a")["calls"] == 0
+    assert router.route("default") == ["a", "b", "c"]
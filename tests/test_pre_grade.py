@@ -0,0 +1,52 @@
+import pytest
+
+@pytest.fixture
+def score(brainwash):
+    def score(solution, answer):
+        result = brainwash.pre_grade_answer(solution, answer)
+        return result and result["score"]
+    return score
+
+@pytest.mark.parametrize("solution, answer", [
+    ("0.5", ".5"),
+    (".5", "0.5"),
+    ("42", "The answer is 42."),
+    ("3.14", "3.14159"),
+    ("1/3", "0.333333333"),
+    ("x = 4", "x=4"),
+    ("1,000", "1000"),
+    ("50%", "0.5"),
+    ("0.5", "50%"),
+])
+def test_correct_numbers(score, solution, answer):
+    assert score(solution, answer) == 100
+
+@pytest.mark.parametrize("solution, answer", [
+    ("1999", "1990"),
+    ("100", "101"),
+    ("365", "362"),
+    ("3.14", "3.1"),
+    ("1/3", "0.33"),
+])
+def test_near_misses_go_to_the_model(score, solution, answer):
+    assert score(solution, answer) is None
+
+@pytest.mark.parametrize("solution, answer", [
+    (".5", "5"),
+    ("0.5", "5"),
+    ("100", "200"),
+    ("42", "-42"),
+])
+def test_wrong_numbers(score, solution, answer):
+    assert score(solution, answer) == 0
+
+@pytest.mark.parametrize("solution, answer", [
+    ("x=2", "x=2 or x=3"),
+    ("x^2+1", "x^2-1"),
+    ("photosynthesis", "photosynthesi"),
+])
+def test_anything_else_goes_to_the_model(score, solution, answer):
+    assert score(solution, answer) is None
+
+def test_empty_answer(score):
+    assert score("42", "  ") == 0